@@ -1,5 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+import contextlib
 import random
+import warnings
 
 import torch
 import torch.nn as nn
@@ -18,7 +20,8 @@ except:
 
 from domainbed import networks
 from domainbed.lib.misc import (
-    random_pairs_of_minibatches, ParamDict, MovingAverage, l2_between_dicts
+    random_pairs_of_minibatches, MovingAverage, l2_between_dicts,
+    env_gradients
 )
 
 
@@ -64,9 +67,25 @@ class Algorithm(torch.nn.Module):
     - update()
     - predict()
     """
+    # The values of hparams['precision'] the algorithm can train with. fp16
+    # needs loss scaling, which the algorithms taking gradients themselves
+    # (e.g. with autograd.grad) do not support; they train in bf16 instead.
+    PRECISIONS = ('fp32', 'bf16', 'fp16')
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(Algorithm, self).__init__()
         self.hparams = hparams
+        # hparams saved before precision was introduced lack it
+        self.precision = hparams.get('precision', 'fp32')
+        if self.precision not in self.PRECISIONS:
+            fallback = 'bf16' if 'bf16' in self.PRECISIONS else 'fp32'
+            warnings.warn('{} does not support {} training, using {}'.format(
+                type(self).__name__, self.precision, fallback))
+            self.precision = fallback
+        # Losses are only scaled in fp16, which is only used on CUDA
+        self.scaler = None
+        if self.precision == 'fp16' and torch.cuda.is_available():
+            self.scaler = torch.amp.GradScaler('cuda')
 
     def update(self, minibatches, unlabeled=None):
         """
@@ -81,6 +100,65 @@ class Algorithm(torch.nn.Module):
     def predict(self, x):
         raise NotImplementedError
 
+    def autocast(self, device_type):
+        """
+        Return a context manager running the forward passes it encloses in
+        the precision of the algorithm. fp16 is only used on CUDA, CPUs run
+        in bf16 instead.
+        """
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        if self.precision == 'fp16' and device_type == 'cuda':
+            return torch.autocast(device_type, dtype=torch.float16)
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+
+    def backward(self, loss):
+        """loss.backward(), with the loss scaled when training in fp16."""
+        if self.scaler is None:
+            loss.backward()
+        else:
+            self.scaler.scale(loss).backward()
+
+    def step(self, *optimizers):
+        """Step the optimizers with the gradients of the last backward(),
+        unless they overflowed in fp16."""
+        if self.scaler is None:
+            for optimizer in optimizers:
+                optimizer.step()
+            return
+        for optimizer in optimizers:
+            self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def training_state_dict(self):
+        """
+        Return the state needed to resume training that is not part of
+        state_dict(): by default, the state of every optimizer attribute.
+        Subclasses with other non-module state should extend it.
+        """
+        return {'optimizers': {name: optimizer.state_dict()
+                    for name, optimizer in self._named_optimizers()},
+                'scaler': (None if self.scaler is None
+                    else self.scaler.state_dict())}
+
+    def load_training_state_dict(self, state_dict):
+        optimizers = dict(self._named_optimizers())
+        for name, optimizer_state in state_dict['optimizers'].items():
+            optimizers[name].load_state_dict(optimizer_state)
+        if state_dict.get('scaler') and self.scaler is not None:
+            self.scaler.load_state_dict(state_dict['scaler'])
+
+    def _named_optimizers(self):
+        """Yield (name, optimizer) for the optimizers held as attributes, or
+        in list attributes, of the algorithm."""
+        for name, value in sorted(vars(self).items()):
+            if isinstance(value, torch.optim.Optimizer):
+                yield name, value
+            elif isinstance(value, (list, tuple)):
+                for i, item in enumerate(value):
+                    if isinstance(item, torch.optim.Optimizer):
+                        yield '{}.{}'.format(name, i), item
+
 class ERM(Algorithm):
     """
     Empirical Risk Minimization (ERM)
@@ -109,10 +187,10 @@ class ERM(Algorithm):
         loss = F.cross_entropy(self.predict(all_x), all_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         return self.network(x)
@@ -123,40 +201,46 @@ class Fish(Algorithm):
     Implementation of Fish, as seen in Gradient Matching for Domain 
     Generalization, Shi et al. 2021.
     """
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(Fish, self).__init__(input_shape, num_classes, num_domains,
                                    hparams)
-        self.input_shape = input_shape
-        self.num_classes = num_classes
-
         self.network = networks.WholeFish(input_shape, num_classes, hparams)
         self.optimizer = torch.optim.Adam(
             self.network.parameters(),
             lr=self.hparams["lr"],
             weight_decay=self.hparams['weight_decay']
         )
-        self.optimizer_inner_state = None
 
-    def create_clone(self, device):
-        self.network_inner = networks.WholeFish(self.input_shape, self.num_classes, self.hparams,
-                                            weights=self.network.state_dict()).to(device)
+        # The inner network and its optimizer persist across updates: every
+        # update copies the weights of network into network_inner in place.
+        # The state of optimizer_inner is deliberately not reset: Fish always
+        # carried it over, reloading it into the inner optimizer it built at
+        # every update. network_inner is not registered as a submodule, so
+        # that it stays out of state_dict(); _apply moves it with the rest.
+        object.__setattr__(self, 'network_inner', networks.WholeFish(
+            input_shape, num_classes, hparams,
+            weights=self.network.state_dict()))
         self.optimizer_inner = torch.optim.Adam(
             self.network_inner.parameters(),
             lr=self.hparams["lr"],
             weight_decay=self.hparams['weight_decay']
         )
-        if self.optimizer_inner_state is not None:
-            self.optimizer_inner.load_state_dict(self.optimizer_inner_state)
 
-    def fish(self, meta_weights, inner_weights, lr_meta):
-        meta_weights = ParamDict(meta_weights)
-        inner_weights = ParamDict(inner_weights)
-        meta_weights += lr_meta * (inner_weights - meta_weights)
-        return meta_weights
+    def _apply(self, fn, *args, **kwargs):
+        self.network_inner._apply(fn, *args, **kwargs)
+        return super(Fish, self)._apply(fn, *args, **kwargs)
+
+    def _float_state(self, network):
+        return [t for t in network.state_dict().values()
+            if t.is_floating_point()]
 
     def update(self, minibatches, unlabeled=None):
-        self.create_clone(minibatches[0][0].device)
+        meta_state = self._float_state(self.network)
+        inner_state = self._float_state(self.network_inner)
+        with torch.no_grad():
+            torch._foreach_copy_(inner_state, meta_state)
 
         for x, y in minibatches:
             loss = F.cross_entropy(self.network_inner(x), y)
@@ -164,15 +248,12 @@ class Fish(Algorithm):
             loss.backward()
             self.optimizer_inner.step()
 
-        self.optimizer_inner_state = self.optimizer_inner.state_dict()
-        meta_weights = self.fish(
-            meta_weights=self.network.state_dict(),
-            inner_weights=self.network_inner.state_dict(),
-            lr_meta=self.hparams["meta_lr"]
-        )
-        self.network.reset_weights(meta_weights)
+        # Move the weights towards the end point of the inner loop
+        with torch.no_grad():
+            torch._foreach_lerp_(meta_state, inner_state,
+                self.hparams["meta_lr"])
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         return self.network(x)
@@ -271,10 +352,10 @@ class ContextERM(ERM):
         total_loss = loss_env_predictor + loss_label_predictor
 
         self.optimizer.zero_grad()
-        total_loss.backward()
-        self.optimizer.step()
+        self.backward(total_loss)
+        self.step(self.optimizer)
 
-        return {'loss': total_loss.item()}
+        return {'loss': total_loss.detach()}
 
     def predict(self, x):
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -296,7 +377,7 @@ class ARM(ERM):
         input_shape = (1 + original_input_shape[0],) + original_input_shape[1:]
         super(ARM, self).__init__(input_shape, num_classes, num_domains,
                                   hparams)
-        self.context_net = networks.ContextNet(original_input_shape)
+        self.context_net = networks.ContextNet(original_input_shape, hparams)
         self.support_size = hparams['batch_size']
 
     def predict(self, x):
@@ -316,6 +397,7 @@ class ARM(ERM):
 
 class AbstractDANN(Algorithm):
     """Domain-Adversarial Neural Networks (abstract class)"""
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains,
                  hparams, conditional, class_balance):
@@ -389,7 +471,7 @@ class AbstractDANN(Algorithm):
             self.disc_opt.zero_grad()
             disc_loss.backward()
             self.disc_opt.step()
-            return {'disc_loss': disc_loss.item()}
+            return {'disc_loss': disc_loss.detach()}
         else:
             all_preds = self.classifier(all_z)
             classifier_loss = F.cross_entropy(all_preds, all_y)
@@ -399,7 +481,7 @@ class AbstractDANN(Algorithm):
             self.gen_opt.zero_grad()
             gen_loss.backward()
             self.gen_opt.step()
-            return {'gen_loss': gen_loss.item()}
+            return {'gen_loss': gen_loss.detach()}
 
     def predict(self, x):
         return self.classifier(self.featurizer(x))
@@ -499,10 +581,10 @@ class BranchOOD(ERM):
         #  and prediction accuracy across different environments
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def predict(self, x):
         inference_encoder = self.network.featurizers[0]
@@ -512,6 +594,7 @@ class BranchOOD(ERM):
 
 class IRM(ERM):
     """Invariant Risk Minimization"""
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(IRM, self).__init__(input_shape, num_classes, num_domains,
@@ -562,8 +645,8 @@ class IRM(ERM):
         self.optimizer.step()
 
         self.update_count += 1
-        return {'loss': loss.item(), 'nll': nll.item(),
-            'penalty': penalty.item()}
+        return {'loss': loss.detach(), 'nll': nll.detach(),
+            'penalty': penalty.detach()}
 
 
 class VREx(ERM):
@@ -604,12 +687,12 @@ class VREx(ERM):
                 weight_decay=self.hparams['weight_decay'])
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
         self.update_count += 1
-        return {'loss': loss.item(), 'nll': nll.item(),
-                'penalty': penalty.item()}
+        return {'loss': loss.detach(), 'nll': nll.detach(),
+                'penalty': penalty.detach()}
 
 
 class Mixup(ERM):
@@ -623,25 +706,34 @@ class Mixup(ERM):
                                     hparams)
 
     def update(self, minibatches, unlabeled=None):
-        objective = 0
-
-        for (xi, yi), (xj, yj) in random_pairs_of_minibatches(minibatches):
-            lam = np.random.beta(self.hparams["mixup_alpha"],
-                                 self.hparams["mixup_alpha"])
-
-            x = lam * xi + (1 - lam) * xj
-            predictions = self.predict(x)
-
-            objective += lam * F.cross_entropy(predictions, yi)
-            objective += (1 - lam) * F.cross_entropy(predictions, yj)
-
-        objective /= len(minibatches)
+        pairs = random_pairs_of_minibatches(minibatches)
+        lams = [np.random.beta(self.hparams["mixup_alpha"],
+                               self.hparams["mixup_alpha"]) for _ in pairs]
+
+        # All the mixed minibatches go through a single forward pass
+        x = torch.cat([lam * xi + (1 - lam) * xj
+            for lam, ((xi, _), (xj, _)) in zip(lams, pairs)])
+        yi = torch.cat([yi for (_, yi), _ in pairs])
+        yj = torch.cat([yj for _, (_, yj) in pairs])
+        predictions = self.predict(x)
+
+        # Each example is weighted by the mixing coefficient of its pair, and
+        # by the inverse of the size of its pair to average over the pair
+        sizes = torch.tensor([len(yi) for (_, yi), _ in pairs],
+            device=x.device)
+        lams = torch.tensor(lams, dtype=torch.float,
+            device=x.device).repeat_interleave(sizes)
+        weights = (1. / sizes).repeat_interleave(sizes)
+        objective = (weights * (
+            lams * F.cross_entropy(predictions, yi, reduction='none') +
+            (1 - lams) * F.cross_entropy(predictions, yj, reduction='none')
+        )).sum() / len(minibatches)
 
         self.optimizer.zero_grad()
-        objective.backward()
-        self.optimizer.step()
+        self.backward(objective)
+        self.step(self.optimizer)
 
-        return {'loss': objective.item()}
+        return {'loss': objective.detach()}
 
 
 class GroupDRO(ERM):
@@ -652,30 +744,25 @@ class GroupDRO(ERM):
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(GroupDRO, self).__init__(input_shape, num_classes, num_domains,
                                         hparams)
-        self.register_buffer("q", torch.Tensor())
+        self.register_buffer("q", torch.ones(num_domains))
 
     def update(self, minibatches, unlabeled=None):
-        device = "cuda" if minibatches[0][0].is_cuda else "cpu"
-
-        if not len(self.q):
-            self.q = torch.ones(len(minibatches)).to(device)
-
-        losses = torch.zeros(len(minibatches)).to(device)
-
-        for m in range(len(minibatches)):
-            x, y = minibatches[m]
-            losses[m] = F.cross_entropy(self.predict(x), y)
-            self.q[m] *= (self.hparams["groupdro_eta"] * losses[m].data).exp()
+        all_x = torch.cat([x for x, y in minibatches])
+        all_y = torch.cat([y for x, y in minibatches])
+        losses = F.cross_entropy(self.predict(all_x), all_y, reduction='none')
+        losses = torch.stack([loss.mean() for loss in
+            losses.split([len(y) for x, y in minibatches])])
 
+        self.q *= (self.hparams["groupdro_eta"] * losses.detach()).exp()
         self.q /= self.q.sum()
 
         loss = torch.dot(losses, self.q)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
 
 class MLDG(ERM):
@@ -685,10 +772,31 @@ class MLDG(ERM):
     Related: https://arxiv.org/pdf/1703.03400.pdf
     Related: https://arxiv.org/pdf/1910.13580.pdf
     """
+    PRECISIONS = ('fp32', 'bf16')
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(MLDG, self).__init__(input_shape, num_classes, num_domains,
                                    hparams)
 
+    def _loss(self, params, frozen, buffers, x, y):
+        return F.cross_entropy(torch.func.functional_call(
+            self.network, (params, frozen, buffers), (x,)), y)
+
+    def _inner_step(self, p, g):
+        """
+        Return p after the first step of a freshly created Adam on gradient
+        g. Bias correction reduces that step to lr * g / (|g| + eps), g
+        including the weight decay term.
+        """
+        g = g + self.hparams['weight_decay'] * p
+        return p - self.hparams["lr"] * g / (g.abs() + 1e-8)
+
+    def _state(self):
+        params, frozen = {}, {}
+        for name, p in self.network.named_parameters():
+            (params if p.requires_grad else frozen)[name] = p
+        return params, frozen, dict(self.network.named_buffers())
+
     def update(self, minibatches, unlabeled=None):
         """
         Terms being computed:
@@ -704,62 +812,93 @@ class MLDG(ERM):
         That is, when calling .step(), we want grads to be Gi + beta * Gj
 
         For computational efficiency, we do not compute second derivatives.
+        The inner step is taken functionally on copies of the parameters, so
+        that the network is never copied; with hparams['mldg_vmap'], all the
+        pairs of minibatches are processed by a single vmapped call.
         """
-        num_mb = len(minibatches)
-        objective = 0
+        pairs = random_pairs_of_minibatches(minibatches)
+        if (self.hparams.get('mldg_vmap', False) and
+                len(set(len(xi) for (xi, _), _ in pairs)) == 1):
+            objective, grads = self._update_vmap(pairs)
+        else:
+            objective, grads = self._update_loop(pairs)
 
+        # Parameters without gradients are stepped too, with zero gradients
         self.optimizer.zero_grad()
-        for p in self.network.parameters():
-            if p.grad is None:
-                p.grad = torch.zeros_like(p)
-
-        for (xi, yi), (xj, yj) in random_pairs_of_minibatches(minibatches):
-            # fine tune clone-network on task "i"
-            inner_net = copy.deepcopy(self.network)
-
-            inner_opt = torch.optim.Adam(
-                inner_net.parameters(),
-                lr=self.hparams["lr"],
-                weight_decay=self.hparams['weight_decay']
-            )
+        for name, p in self.network.named_parameters():
+            p.grad = grads.get(name, torch.zeros_like(p))
+        self.optimizer.step()
 
-            inner_obj = F.cross_entropy(inner_net(xi), yi)
+        return {'loss': objective}
 
-            inner_opt.zero_grad()
-            inner_obj.backward()
-            inner_opt.step()
+    def _update_loop(self, pairs):
+        num_mb = len(pairs)
+        beta = self.hparams['mldg_beta']
+        params, frozen, buffers = self._state()
+        names = list(params.keys())
+        grads = {name: torch.zeros_like(p) for name, p in params.items()}
+        objective = 0
 
-            # The network has now accumulated gradients Gi
-            # The clone-network has now parameters P - lr * Gi
-            for p_tgt, p_src in zip(self.network.parameters(),
-                                    inner_net.parameters()):
-                if p_src.grad is not None:
-                    p_tgt.grad.data.add_(p_src.grad.data / num_mb)
+        for (xi, yi), (xj, yj) in pairs:
+            # The running statistics are only updated on copies, as they
+            # were on the deep copies of the network
+            pair_buffers = {name: b.clone() for name, b in buffers.items()}
 
-            # `objective` is populated for reporting purposes
-            objective += inner_obj.item()
-
-            # this computes Gj on the clone-network
-            loss_inner_j = F.cross_entropy(inner_net(xj), yj)
-            grad_inner_j = autograd.grad(loss_inner_j, inner_net.parameters(),
+            loss_i = self._loss(params, frozen, pair_buffers, xi, yi)
+            grad_i = autograd.grad(loss_i, list(params.values()),
                 allow_unused=True)
 
-            # `objective` is populated for reporting purposes
-            objective += (self.hparams['mldg_beta'] * loss_inner_j).item()
-
-            for p, g_j in zip(self.network.parameters(), grad_inner_j):
+            # Parameters without gradients are not stepped by the inner Adam
+            inner_params = {}
+            for name, g_i in zip(names, grad_i):
+                p = params[name].detach()
+                if g_i is not None:
+                    grads[name] += g_i / num_mb
+                    p = self._inner_step(p, g_i)
+                inner_params[name] = p.requires_grad_()
+
+            loss_j = self._loss(inner_params, frozen, pair_buffers, xj, yj)
+            grad_j = autograd.grad(loss_j, list(inner_params.values()),
+                allow_unused=True)
+            for name, g_j in zip(names, grad_j):
                 if g_j is not None:
-                    p.grad.data.add_(
-                        self.hparams['mldg_beta'] * g_j.data / num_mb)
+                    grads[name] += beta * g_j / num_mb
 
-            # The network has now accumulated gradients Gi + beta * Gj
-            # Repeat for all train-test splits, do .step()
-
-        objective /= len(minibatches)
-
-        self.optimizer.step()
-
-        return {'loss': objective}
+            # `objective` is populated for reporting purposes
+            objective += loss_i.detach() + beta * loss_j.detach()
+
+        return objective / num_mb, grads
+
+    def _update_vmap(self, pairs):
+        num_mb = len(pairs)
+        beta = self.hparams['mldg_beta']
+        params, frozen, buffers = self._state()
+        params = {name: p.detach() for name, p in params.items()}
+        frozen = {name: p.detach() for name, p in frozen.items()}
+        # Each pair updates its own copy of the running statistics
+        buffers = {name: b.unsqueeze(0).repeat(num_mb, *([1] * b.dim()))
+            for name, b in buffers.items()}
+        xi, yi, xj, yj = [torch.stack(t) for t in
+            zip(*[(xi, yi, xj, yj) for (xi, yi), (xj, yj) in pairs])]
+
+        # torch.func returns zero gradients for the parameters that the loss
+        # does not use, where _update_loop gets None and leaves them alone.
+        # Since the weight decay would still move them, keep their values.
+        def pair_grads(buffers, xi, yi, xj, yj):
+            grad_i, loss_i = torch.func.grad_and_value(self._loss)(
+                params, frozen, buffers, xi, yi)
+            inner_params = {name: torch.where((grad_i[name] != 0).any(),
+                    self._inner_step(p, grad_i[name]), p)
+                for name, p in params.items()}
+            grad_j, loss_j = torch.func.grad_and_value(self._loss)(
+                inner_params, frozen, buffers, xj, yj)
+            return loss_i + beta * loss_j, grad_i, grad_j
+
+        losses, grad_i, grad_j = torch.func.vmap(pair_grads,
+            randomness='different')(buffers, xi, yi, xj, yj)
+        grads = {name: (grad_i[name].sum(0) + beta * grad_j[name].sum(0))
+            / num_mb for name in params}
+        return losses.mean().detach(), grads
 
     # This commented "update" method back-propagates through the gradients of
     # the inner update, as suggested in the original MAML paper.  However, this
@@ -817,58 +956,81 @@ class AbstractMMD(ERM):
     def gaussian_kernel(self, x, y, gamma=[0.001, 0.01, 0.1, 1, 10, 100,
                                            1000]):
         D = self.my_cdist(x, y)
-        K = torch.zeros_like(D)
+        gamma = torch.tensor(gamma, dtype=D.dtype, device=D.device)
+        return torch.exp(D.unsqueeze(0) * -gamma.view(-1, 1, 1)).sum(0)
 
-        for g in gamma:
-            K.add_(torch.exp(D.mul(-g)))
-
-        return K
-
-    def mmd(self, x, y):
+    def random_fourier_features(self, x, gamma=[0.001, 0.01, 0.1, 1, 10, 100,
+                                                1000]):
+        """
+        Return random features of x whose dot products are unbiased
+        estimates of gaussian_kernel, with hparams['mmd_rff_dim'] features
+        per gamma.
+        """
+        n_features = self.hparams.get('mmd_rff_dim', 0)
+        gamma = torch.tensor(gamma, device=x.device)
+        w = (torch.randn(len(gamma), x.shape[1], n_features, device=x.device)
+             * (2 * gamma).sqrt().view(-1, 1, 1))
+        b = 2 * np.pi * torch.rand(len(gamma), 1, n_features, device=x.device)
+        features = np.sqrt(2. / n_features) * torch.cos(x @ w + b)
+        return features.transpose(0, 1).flatten(1)
+
+    def penalty(self, features, sizes):
+        """
+        Return the sum of the MMDs between all pairs of environments, given
+        the concatenated features of the environments and their sizes.
+        """
         if self.kernel_type == "gaussian":
-            Kxx = self.gaussian_kernel(x, x).mean()
-            Kyy = self.gaussian_kernel(y, y).mean()
-            Kxy = self.gaussian_kernel(x, y).mean()
-            return Kxx + Kyy - 2 * Kxy
+            # Averages over each environment
+            weights = torch.block_diag(*[torch.full((1, n), 1. / n)
+                for n in sizes]).to(features.device)
+            if self.hparams.get('mmd_rff_dim', 0):
+                means = weights @ self.random_fourier_features(features)
+                K = means @ means.t()
+            else:
+                K = (weights @ self.gaussian_kernel(features, features)
+                     @ weights.t())
+            # K[i, j] is the mean kernel between environments i and j
+            Kii = K.diagonal()
+            mmds = Kii.unsqueeze(0) + Kii.unsqueeze(1) - 2 * K
+            return mmds.triu(1).sum()
         else:
-            mean_x = x.mean(0, keepdim=True)
-            mean_y = y.mean(0, keepdim=True)
-            cent_x = x - mean_x
-            cent_y = y - mean_y
-            cova_x = (cent_x.t() @ cent_x) / (len(x) - 1)
-            cova_y = (cent_y.t() @ cent_y) / (len(y) - 1)
-
-            mean_diff = (mean_x - mean_y).pow(2).mean()
-            cova_diff = (cova_x - cova_y).pow(2).mean()
-
-            return mean_diff + cova_diff
+            features = features.split(sizes)
+            means = [x.mean(0, keepdim=True) for x in features]
+            covas = [(x - mean_x).t() @ (x - mean_x) / (len(x) - 1)
+                for x, mean_x in zip(features, means)]
+
+            penalty = 0
+            for i in range(len(features)):
+                for j in range(i + 1, len(features)):
+                    mean_diff = (means[i] - means[j]).pow(2).mean()
+                    cova_diff = (covas[i] - covas[j]).pow(2).mean()
+                    penalty += mean_diff + cova_diff
+            return penalty
 
     def update(self, minibatches, unlabeled=None):
-        objective = 0
         penalty = 0
         nmb = len(minibatches)
+        sizes = [len(x) for x, _ in minibatches]
 
-        features = [self.featurizer(xi) for xi, _ in minibatches]
-        classifs = [self.classifier(fi) for fi in features]
-        targets = [yi for _, yi in minibatches]
-
-        for i in range(nmb):
-            objective += F.cross_entropy(classifs[i], targets[i])
-            for j in range(i + 1, nmb):
-                penalty += self.mmd(features[i], features[j])
+        all_x = torch.cat([x for x, y in minibatches])
+        all_y = torch.cat([y for x, y in minibatches])
+        features = self.featurizer(all_x)
+        losses = F.cross_entropy(self.classifier(features), all_y,
+            reduction='none')
+        objective = torch.stack([loss.mean() for loss in
+            losses.split(sizes)]).mean()
 
-        objective /= nmb
         if nmb > 1:
-            penalty /= (nmb * (nmb - 1) / 2)
+            penalty = self.penalty(features, sizes) / (nmb * (nmb - 1) / 2)
 
         self.optimizer.zero_grad()
-        (objective + (self.hparams['mmd_gamma']*penalty)).backward()
-        self.optimizer.step()
+        self.backward(objective + (self.hparams['mmd_gamma']*penalty))
+        self.step(self.optimizer)
 
         if torch.is_tensor(penalty):
-            penalty = penalty.item()
+            penalty = penalty.detach()
 
-        return {'loss': objective.item(), 'penalty': penalty}
+        return {'loss': objective.detach(), 'penalty': penalty}
 
 
 class MMD(AbstractMMD):
@@ -925,10 +1087,10 @@ class MTL(Algorithm):
             loss += F.cross_entropy(self.predict(x, env), y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
     def update_embeddings_(self, features, env=None):
         return_embedding = features.mean(0)
@@ -1044,31 +1206,32 @@ class SagNet(Algorithm):
         self.optimizer_f.zero_grad()
         self.optimizer_c.zero_grad()
         loss_c = F.cross_entropy(self.forward_c(all_x), all_y)
-        loss_c.backward()
-        self.optimizer_f.step()
-        self.optimizer_c.step()
+        self.backward(loss_c)
+        self.step(self.optimizer_f, self.optimizer_c)
 
         # learn style
         self.optimizer_s.zero_grad()
         loss_s = F.cross_entropy(self.forward_s(all_x), all_y)
-        loss_s.backward()
-        self.optimizer_s.step()
+        self.backward(loss_s)
+        self.step(self.optimizer_s)
 
         # learn adversary
         self.optimizer_f.zero_grad()
         loss_adv = -F.log_softmax(self.forward_s(all_x), dim=1).mean(1).mean()
         loss_adv = loss_adv * self.weight_adv
-        loss_adv.backward()
-        self.optimizer_f.step()
+        self.backward(loss_adv)
+        self.step(self.optimizer_f)
 
-        return {'loss_c': loss_c.item(), 'loss_s': loss_s.item(),
-                'loss_adv': loss_adv.item()}
+        return {'loss_c': loss_c.detach(), 'loss_s': loss_s.detach(),
+                'loss_adv': loss_adv.detach()}
 
     def predict(self, x):
         return self.network_c(self.network_f(x))
 
 
 class RSC(ERM):
+    PRECISIONS = ('fp32', 'bf16')
+
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(RSC, self).__init__(input_shape, num_classes, num_domains,
                                    hparams)
@@ -1122,7 +1285,7 @@ class RSC(ERM):
         loss.backward()
         self.optimizer.step()
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
 
 class SD(ERM):
@@ -1145,16 +1308,17 @@ class SD(ERM):
         objective = loss + self.sd_reg * penalty
 
         self.optimizer.zero_grad()
-        objective.backward()
-        self.optimizer.step()
+        self.backward(objective)
+        self.step(self.optimizer)
 
-        return {'loss': loss.item(), 'penalty': penalty.item()}
+        return {'loss': loss.detach(), 'penalty': penalty.detach()}
 
 class ANDMask(ERM):
     """
     Learning Explanations that are Hard to Vary [https://arxiv.org/abs/2009.00329]
     AND-Mask implementation from [https://github.com/gibipara92/learning-explanations-hard-to-vary]
     """
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(ANDMask, self).__init__(input_shape, num_classes, num_domains, hparams)
@@ -1162,28 +1326,17 @@ class ANDMask(ERM):
         self.tau = hparams["tau"]
 
     def update(self, minibatches, unlabeled=None):
-        mean_loss = 0
-        param_gradients = [[] for _ in self.network.parameters()]
-        for i, (x, y) in enumerate(minibatches):
-            logits = self.network(x)
-            
-            env_loss = F.cross_entropy(logits, y)
-            mean_loss += env_loss.item() / len(minibatches)
-
-            env_grads = autograd.grad(env_loss, self.network.parameters())
-            for grads, env_grad in zip(param_gradients, env_grads):
-                grads.append(env_grad)
+        env_losses, param_gradients = env_gradients(self.network, minibatches)
 
         self.optimizer.zero_grad()
         self.mask_grads(self.tau, param_gradients, self.network.parameters())
         self.optimizer.step()
 
-        return {'loss': mean_loss}
+        return {'loss': env_losses.mean().detach()}
 
     def mask_grads(self, tau, gradients, params):
 
         for param, grads in zip(params, gradients):
-            grads = torch.stack(grads, dim=0)
             grad_signs = torch.sign(grads)
             mask = torch.mean(grad_signs, dim=0).abs() >= self.tau
             mask = mask.to(torch.float32)
@@ -1200,33 +1353,21 @@ class IGA(ERM):
     Inter-environmental Gradient Alignment
     From https://arxiv.org/abs/2008.01883v2
     """
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, in_features, num_classes, num_domains, hparams):
         super(IGA, self).__init__(in_features, num_classes, num_domains, hparams)
 
     def update(self, minibatches, unlabeled=False):
-        total_loss = 0
-        grads = []
-        for i, (x, y) in enumerate(minibatches):
-            logits = self.network(x)
-
-            env_loss = F.cross_entropy(logits, y)
-            total_loss += env_loss
-
-            env_grad = autograd.grad(env_loss, self.network.parameters(), 
-                                        create_graph=True)
+        env_losses, grads = env_gradients(self.network, minibatches,
+            create_graph=True)
+        mean_loss = env_losses.mean()
 
-            grads.append(env_grad)
-            
-        mean_loss = total_loss / len(minibatches)
-        mean_grad = autograd.grad(mean_loss, self.network.parameters(), 
-                                        retain_graph=True)
-
-        # compute trace penalty
+        # compute trace penalty, the gradient of mean_loss being the mean of
+        # the gradients of the environments
         penalty_value = 0
-        for grad in grads:
-            for g, mean_g in zip(grad, mean_grad):
-                penalty_value += (g - mean_g).pow(2).sum()
+        for g in grads:
+            penalty_value += (g - g.mean(0).detach()).pow(2).sum()
 
         objective = mean_loss + self.hparams['penalty'] * penalty_value
 
@@ -1234,7 +1375,7 @@ class IGA(ERM):
         objective.backward()
         self.optimizer.step()
 
-        return {'loss': mean_loss.item(), 'penalty': penalty_value.item()}
+        return {'loss': mean_loss.detach(), 'penalty': penalty_value.detach()}
     
     
 class SelfReg(ERM):
@@ -1320,10 +1461,10 @@ class SelfReg(ERM):
         loss = cl_loss + C_scale*(lam*(L_ind_logit + L_ind_feat)+(1-lam)*(L_hdl_logit + L_hdl_feat))
      
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
-        return {'loss': loss.item()}
+        return {'loss': loss.detach()}
 
 
 class SANDMask(ERM):
@@ -1331,6 +1472,7 @@ class SANDMask(ERM):
     SAND-mask: An Enhanced Gradient Masking Strategy for the Discovery of Invariances in Domain Generalization
     <https://arxiv.org/abs/2106.02266>
     """
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(SANDMask, self).__init__(input_shape, num_classes, num_domains, hparams)
@@ -1348,17 +1490,7 @@ class SANDMask(ERM):
         self.register_buffer('update_count', torch.tensor([0]))
 
     def update(self, minibatches, unlabeled=None):
-
-        mean_loss = 0
-        param_gradients = [[] for _ in self.network.parameters()]
-        for i, (x, y) in enumerate(minibatches):
-            logits = self.network(x)
-
-            env_loss = F.cross_entropy(logits, y)
-            mean_loss += env_loss.item() / len(minibatches)
-            env_grads = autograd.grad(env_loss, self.network.parameters(), retain_graph=True)
-            for grads, env_grad in zip(param_gradients, env_grads):
-                grads.append(env_grad)
+        env_losses, param_gradients = env_gradients(self.network, minibatches)
 
         self.optimizer.zero_grad()
         # gradient masking applied here
@@ -1366,16 +1498,15 @@ class SANDMask(ERM):
         self.optimizer.step()
         self.update_count += 1
 
-        return {'loss': mean_loss}
+        return {'loss': env_losses.mean().detach()}
 
     def mask_grads(self, gradients, params):
         '''
         Here a mask with continuous values in the range [0,1] is formed to control the amount of update for each
         parameter based on the agreement of gradients coming from different environments.
         '''
-        device = gradients[0][0].device
+        device = gradients[0].device
         for param, grads in zip(params, gradients):
-            grads = torch.stack(grads, dim=0)
             avg_grad = torch.mean(grads, dim=0)
             grad_signs = torch.sign(grads)
             gamma = torch.tensor(1.0).to(device)
@@ -1393,6 +1524,8 @@ class SANDMask(ERM):
 
 class Fishr(Algorithm):
     "Invariant Gradients variances for Out-of-distribution Generalization"
+    # BackPACK's per-sample gradients are computed in fp32
+    PRECISIONS = ('fp32',)
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         assert backpack is not None, "Install backpack with: 'pip install backpack-for-pytorch==1.3.0'"
@@ -1450,7 +1583,7 @@ class Fishr(Algorithm):
         objective.backward()
         self.optimizer.step()
 
-        return {'loss': objective.item(), 'nll': all_nll.item(), 'penalty': penalty.item()}
+        return {'loss': objective.detach(), 'nll': all_nll.detach(), 'penalty': penalty.detach()}
 
     def compute_fishr_penalty(self, all_logits, all_y, len_minibatches):
         dict_grads = self._get_grads(all_logits, all_y)
@@ -1521,11 +1654,27 @@ class Fishr(Algorithm):
     def predict(self, x):
         return self.network(x)
 
+    def training_state_dict(self):
+        state_dict = super(Fishr, self).training_state_dict()
+        state_dict['ema_per_domain'] = [(ema.ema_data, ema._updates)
+            for ema in self.ema_per_domain]
+        return state_dict
+
+    def load_training_state_dict(self, state_dict):
+        super(Fishr, self).load_training_state_dict(state_dict)
+        device = next(self.parameters()).device
+        for ema, (ema_data, updates) in zip(self.ema_per_domain,
+                                            state_dict['ema_per_domain']):
+            ema.ema_data = {name: data.to(device)
+                for name, data in ema_data.items()}
+            ema._updates = updates
+
 class TRM(Algorithm):
     """
     Learning Representations that Support Robust Transfer of Predictors
     <https://arxiv.org/abs/2110.09940>
     """
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(TRM, self).__init__(input_shape, num_classes, num_domains,hparams)
@@ -1663,7 +1812,7 @@ class TRM(Algorithm):
             all_feature = self.featurizer(all_x)
             loss = F.cross_entropy(self.classifier(all_feature), all_y)
 
-        nll = loss.item()
+        nll = loss.detach()
         self.optimizer_c.zero_grad()
         self.optimizer_f.zero_grad()
         if self.update_count >= self.hparams['iters']:
@@ -1675,7 +1824,7 @@ class TRM(Algorithm):
         self.optimizer_f.step()
         self.optimizer_c.step()
 
-        loss_swap = loss_swap.item() - nll
+        loss_swap = loss_swap.detach() - nll
         self.update_count += 1
 
         return {'nll': nll, 'trm_loss': loss_swap}
@@ -1683,6 +1832,18 @@ class TRM(Algorithm):
     def predict(self, x):
         return self.classifier(self.featurizer(x))
 
+    def training_state_dict(self):
+        state_dict = super(TRM, self).training_state_dict()
+        state_dict['clist'] = [c.state_dict() for c in self.clist]
+        state_dict['alpha'] = self.alpha
+        return state_dict
+
+    def load_training_state_dict(self, state_dict):
+        super(TRM, self).load_training_state_dict(state_dict)
+        for c, c_state in zip(self.clist, state_dict['clist']):
+            c.load_state_dict(c_state)
+        self.alpha.copy_(state_dict['alpha'])
+
     def train(self):
         self.featurizer.train()
 
@@ -1738,16 +1899,17 @@ class IB_ERM(ERM):
                 weight_decay=self.hparams['weight_decay'])
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.backward(loss)
+        self.step(self.optimizer)
 
         self.update_count += 1
-        return {'loss': loss.item(), 
-                'nll': nll.item(),
-                'IB_penalty': ib_penalty.item()}
+        return {'loss': loss.detach(), 
+                'nll': nll.detach(),
+                'IB_penalty': ib_penalty.detach()}
 
 class IB_IRM(ERM):
     """Information Bottleneck based IRM on feature with conditionning"""
+    PRECISIONS = ('fp32', 'bf16')
 
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(IB_IRM, self).__init__(input_shape, num_classes, num_domains,
@@ -1817,7 +1979,7 @@ class IB_IRM(ERM):
         self.optimizer.step()
 
         self.update_count += 1
-        return {'loss': loss.item(), 
-                'nll': nll.item(),
-                'IRM_penalty': irm_penalty.item(), 
-                'IB_penalty': ib_penalty.item()}
+        return {'loss': loss.detach(), 
+                'nll': nll.detach(),
+                'IRM_penalty': irm_penalty.detach(), 
+                'IB_penalty': ib_penalty.detach()}
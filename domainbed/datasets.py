@@ -1,17 +1,21 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
+import math
 import os
+import warnings
+import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image, ImageFile
 from torchvision import transforms
-import torchvision.datasets.folder
 from torch.utils.data import TensorDataset, Subset
 from torchvision.datasets import MNIST, ImageFolder
-from torchvision.transforms.functional import rotate
 
 from wilds.datasets.camelyon17_dataset import Camelyon17Dataset
 from wilds.datasets.fmow_dataset import FMoWDataset
 
+from domainbed.lib import dataset_cache
+
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 DATASETS = [
@@ -67,7 +71,8 @@ class Debug(MultipleDomainDataset):
         for _ in [0, 1, 2]:
             self.datasets.append(
                 TensorDataset(
-                    torch.randn(16, *self.INPUT_SHAPE),
+                    torch.randint(0, 256, (16, *self.INPUT_SHAPE),
+                                  dtype=torch.uint8),
                     torch.randint(0, self.num_classes, (16,))
                 )
             )
@@ -83,11 +88,34 @@ class Debug224(Debug):
 
 class MultipleEnvironmentMNIST(MultipleDomainDataset):
     def __init__(self, root, environments, dataset_transform, input_shape,
-                 num_classes):
+                 num_classes, use_cache=False):
         super().__init__()
         if root is None:
             raise ValueError('Data directory not specified!')
 
+        self.datasets = None
+
+        if use_cache:
+            # The environments are a function of the dataset class, of the
+            # environment parameters and of the RNG state used to shuffle and
+            # transform them, so these make up the key. On a cache hit, the
+            # RNG is left in the same state as if the environments had been
+            # built.
+            cache_path = os.path.join(dataset_cache.cache_dir(root),
+                dataset_cache.cache_key(type(self).__name__, environments,
+                    torch.get_rng_state().numpy().tobytes()))
+            self.datasets = self.load_cache(cache_path, len(environments))
+
+        if self.datasets is None:
+            self.datasets = self.make_environments(root, environments,
+                dataset_transform)
+            if use_cache:
+                self.save_cache(cache_path)
+
+        self.input_shape = input_shape
+        self.num_classes = num_classes
+
+    def make_environments(self, root, environments, dataset_transform):
         original_dataset_tr = MNIST(root, train=True, download=True)
         original_dataset_te = MNIST(root, train=False, download=True)
 
@@ -102,15 +130,39 @@ class MultipleEnvironmentMNIST(MultipleDomainDataset):
         original_images = original_images[shuffle]
         original_labels = original_labels[shuffle]
 
-        self.datasets = []
+        datasets = []
 
         for i in range(len(environments)):
             images = original_images[i::len(environments)]
             labels = original_labels[i::len(environments)]
-            self.datasets.append(dataset_transform(images, labels, environments[i]))
-
-        self.input_shape = input_shape
-        self.num_classes = num_classes
+            datasets.append(dataset_transform(images, labels, environments[i]))
+
+        return datasets
+
+    def load_cache(self, path, n_environments):
+        """
+        Return the cached environments, as tensors backed by read-only memory
+        maps shared by all the jobs on a host, or None on a cache miss. These
+        tensors must not be modified in place.
+        """
+        arrays = dataset_cache.load_arrays(path)
+        if arrays is None:
+            return None
+        torch.set_rng_state(torch.from_numpy(np.array(arrays['rng_state'])))
+        with warnings.catch_warnings():
+            # torch warns about wrapping non-writable arrays
+            warnings.simplefilter('ignore', UserWarning)
+            return [TensorDataset(torch.from_numpy(arrays['x{}'.format(i)]),
+                                  torch.from_numpy(arrays['y{}'.format(i)]))
+                    for i in range(n_environments)]
+
+    def save_cache(self, path):
+        arrays = {'rng_state': torch.get_rng_state().numpy()}
+        for i, env in enumerate(self.datasets):
+            arrays['x{}'.format(i)] = env.tensors[0].numpy()
+            arrays['y{}'.format(i)] = env.tensors[1].numpy()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dataset_cache.save_arrays(path, **arrays)
 
 
 class ColoredMNIST(MultipleEnvironmentMNIST):
@@ -118,7 +170,9 @@ class ColoredMNIST(MultipleEnvironmentMNIST):
 
     def __init__(self, root, test_envs, hparams):
         super(ColoredMNIST, self).__init__(root, [0.1, 0.2, 0.9],
-                                         self.color_dataset, (2, 28, 28,), 2)
+                                         self.color_dataset, (2, 28, 28,), 2,
+                                         use_cache=hparams.get(
+                                             'dataset_cache', False))
 
         self.input_shape = (2, 28, 28,)
         self.num_classes = 2
@@ -141,7 +195,8 @@ class ColoredMNIST(MultipleEnvironmentMNIST):
         images[torch.tensor(range(len(images))), (
             1 - colors).long(), :, :] *= 0
 
-        x = images.float().div_(255.0)
+        # Kept as uint8, see misc.to_float_images
+        x = images
         y = labels.view(-1).long()
 
         return TensorDataset(x, y)
@@ -158,32 +213,97 @@ class RotatedMNIST(MultipleEnvironmentMNIST):
 
     def __init__(self, root, test_envs, hparams):
         super(RotatedMNIST, self).__init__(root, [0, 15, 30, 45, 60, 75],
-                                           self.rotate_dataset, (1, 28, 28,), 10)
+                                           self.rotate_dataset, (1, 28, 28,), 10,
+                                           use_cache=hparams.get(
+                                               'dataset_cache', False))
 
     def rotate_dataset(self, images, labels, angle):
-        rotation = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Lambda(lambda x: rotate(x, angle, fill=(0,),
-                interpolation=torchvision.transforms.InterpolationMode.BILINEAR)),
-            transforms.ToTensor()])
-
-        x = torch.zeros(len(images), 1, 28, 28)
-        for i in range(len(images)):
-            x[i] = rotation(images[i])
+        # Rotate all the images with one bilinear resample, the way
+        # torchvision's rotate() does: counter-clockwise about the center,
+        # filling with zeros. The result is stored as uint8 again.
+        theta = math.radians(angle)
+        matrix = torch.tensor([[math.cos(theta), -math.sin(theta), 0.],
+                               [math.sin(theta), math.cos(theta), 0.]])
+
+        x = images.unsqueeze(1).float()
+        grid = F.affine_grid(matrix.expand(len(x), 2, 3), list(x.shape),
+                             align_corners=False)
+        x = F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros',
+                          align_corners=False)
+        x = x.round_().clamp_(0, 255).to(torch.uint8)
 
         y = labels.view(-1)
 
         return TensorDataset(x, y)
 
 
+class CachedImageFolder(torch.utils.data.Dataset):
+    """
+    Wraps an ImageFolder so that every image is decoded and resized only once,
+    into a uint8 array memory-mapped from the dataset cache. The transform of
+    the ImageFolder is applied to the resized image.
+    """
+    def __init__(self, image_folder, resize, path):
+        super().__init__()
+        self.classes = image_folder.classes
+        self.targets = image_folder.targets
+        self.transform = image_folder.transform
+        self.path = path
+        self._images = None
+
+        if dataset_cache.load_arrays(path) is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with dataset_cache.locked(path):
+                # Another job may have built the entry while we waited
+                if dataset_cache.load_arrays(path) is None:
+                    self._write(image_folder, resize)
+
+    def _write(self, image_folder, resize):
+        shape = (len(image_folder),) + tuple(resize.size) + (3,)
+        with dataset_cache.writing(self.path) as tmp_path:
+            images = np.lib.format.open_memmap(
+                os.path.join(tmp_path, "images.npy"), mode="w+",
+                dtype=np.uint8, shape=shape)
+            for i, (image_path, _) in enumerate(image_folder.samples):
+                images[i] = np.asarray(resize(image_folder.loader(image_path)))
+            images.flush()
+            del images
+
+    def __getitem__(self, index):
+        # Opened lazily, so that each DataLoader worker maps the file itself
+        if self._images is None:
+            self._images = dataset_cache.load_arrays(self.path)["images"]
+        x = Image.fromarray(self._images[index])
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+
 class MultipleEnvironmentImageFolder(MultipleDomainDataset):
     def __init__(self, root, test_envs, augment, hparams):
         super().__init__()
         environments = [f.name for f in os.scandir(root) if f.is_dir()]
         environments = sorted(environments)
 
+        resize = transforms.Resize((224,224))
+
         transform = transforms.Compose([
-            transforms.Resize((224,224)),
+            resize,
+            transforms.ToTensor(),
+            transforms.Normalize(
+                mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ])
+
+        # Cached images are stored after the resize
+        cached_transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize(
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
@@ -200,11 +320,23 @@ class MultipleEnvironmentImageFolder(MultipleDomainDataset):
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
+        use_cache = hparams.get('dataset_cache', False)
+        cache_root = dataset_cache.cache_dir(
+            os.path.dirname(os.path.normpath(root)))
+
         self.datasets = []
         for i, environment in enumerate(environments):
 
-            if augment and (i not in test_envs):
+            # Augmented environments crop the original images, not the
+            # resized ones, so they are never cached: the cache must not
+            # change the inputs.
+            augment_env = augment and (i not in test_envs)
+            cache_env = use_cache and not augment_env
+
+            if augment_env:
                 env_transform = augment_transform
+            elif cache_env:
+                env_transform = cached_transform
             else:
                 env_transform = transform
 
@@ -212,6 +344,13 @@ class MultipleEnvironmentImageFolder(MultipleDomainDataset):
             env_dataset = ImageFolder(path,
                 transform=env_transform)
 
+            if cache_env:
+                key = dataset_cache.cache_key(
+                    type(self).__name__, environment, repr(resize),
+                    [os.path.relpath(p, path) for p, _ in env_dataset.samples])
+                env_dataset = CachedImageFolder(env_dataset, resize,
+                    os.path.join(cache_root, key))
+
             self.datasets.append(env_dataset)
 
         self.input_shape = (3, 224, 224,)
@@ -291,6 +430,9 @@ class WILDSEnvironment:
     def __len__(self):
         return len(self.indices)
 
+    def labels(self):
+        return self.dataset.y_array[self.indices].numpy()
+
 
 class WILDSDataset(MultipleDomainDataset):
     INPUT_SHAPE = (3, 224, 224)
@@ -30,7 +30,15 @@ def _hparams(algorithm, dataset, random_seed):
     _hparam('data_augmentation', True, lambda r: True)
     _hparam('resnet18', False, lambda r: False)
     _hparam('resnet_dropout', 0., lambda r: r.choice([0., 0.1, 0.5]))
+    _hparam('resnet_fold_bn', False, lambda r: False)
+    # Number of activation checkpointing segments, or 0 to disable
+    _hparam('resnet_checkpoint_segments', 0, lambda r: 0)
     _hparam('class_balanced', False, lambda r: False)
+    _hparam('dataset_cache', False, lambda r: False)
+    # 'fp32', 'bf16' or 'fp16' (with loss scaling, on CUDA only)
+    _hparam('precision', 'fp32', lambda r: 'fp32')
+    _hparam('compile', False, lambda r: False)
+    _hparam('channels_last', False, lambda r: False)
     # TODO: nonlinear classifiers disabled
     _hparam('nonlinear_classifier', False,
             lambda r: bool(r.choice([False, False])))
@@ -73,9 +81,13 @@ def _hparams(algorithm, dataset, random_seed):
 
     elif algorithm == "MMD" or algorithm == "CORAL":
         _hparam('mmd_gamma', 1., lambda r: 10**r.uniform(-1, 1))
+        # Random Fourier features per kernel bandwidth approximating the MMD,
+        # or 0 to compute it exactly
+        _hparam('mmd_rff_dim', 0, lambda r: 0)
 
     elif algorithm == "MLDG":
         _hparam('mldg_beta', 1., lambda r: 10**r.uniform(-1, 1))
+        _hparam('mldg_vmap', False, lambda r: False)
 
     elif algorithm == "MTL":
         _hparam('mtl_ema', .99, lambda r: r.choice([0.5, 0.9, 0.99, 1.]))
@@ -0,0 +1,86 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+"""
+On-disk cache of preprocessed dataset arrays, shared by all the jobs of a
+sweep. Every cache entry is a directory of .npy files which is written once,
+atomically, and afterwards only ever memory-mapped read-only.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+
+def cache_dir(data_dir):
+    """Return the directory holding the cache entries for a given data_dir."""
+    return os.path.join(data_dir, "domainbed_cache")
+
+
+def cache_key(*args):
+    """
+    Derive a file name from all args. Two entries share a key only if they were
+    built from identical args.
+    """
+    args_str = str(args)
+    return hashlib.md5(args_str.encode("utf-8")).hexdigest()
+
+
+def load_arrays(path):
+    """
+    Return a dict mapping names to read-only memory-mapped arrays for the
+    cache entry at path, or None if the entry has not been written yet.
+    """
+    if not os.path.isdir(path):
+        return None
+    return {os.path.splitext(fname)[0]:
+                np.load(os.path.join(path, fname), mmap_mode="r")
+            for fname in sorted(os.listdir(path)) if fname.endswith(".npy")}
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Context manager holding an exclusive lock on the cache entry at path, so
+    that concurrent jobs building the same entry wait for the first one
+    instead of all building it. Callers should check for the entry again once
+    the lock is held.
+    """
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def writing(path):
+    """
+    Context manager yielding a temporary directory, which is moved to path
+    when the block exits without raising. When several processes build the
+    same entry concurrently, the first one to finish wins and the others
+    discard their copy.
+    """
+    tmp_path = "{}.tmp-{}".format(path, uuid.uuid4().hex)
+    os.makedirs(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def save_arrays(path, **arrays):
+    """Atomically write the given named arrays as the cache entry at path."""
+    with writing(path) as tmp_path:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
@@ -1,42 +1,156 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
+import bisect
+import time
+
 import torch
 
+from domainbed.lib import misc
+
 class _InfiniteSampler(torch.utils.data.Sampler):
-    """Wraps another Sampler to yield an infinite stream."""
-    def __init__(self, sampler):
+    """Wraps another Sampler to yield an infinite stream, optionally skipping
+    its first few elements."""
+    def __init__(self, sampler, skip=0):
         self.sampler = sampler
+        self.skip = skip
 
     def __iter__(self):
+        skip = self.skip
         while True:
             for batch in self.sampler:
+                if skip > 0:
+                    skip -= 1
+                    continue
                 yield batch
 
+def _tensor_batch_fetcher(dataset):
+    """
+    If dataset is an in-memory TensorDataset, or a (nested) split of one,
+    return a function mapping a batch of indices to the collated minibatch,
+    with a single fancy-indexing operation per tensor. Otherwise return None.
+    Fetching such batches in the main process is faster than collating
+    individual samples in worker processes.
+    """
+    keys = None
+    while isinstance(dataset, misc._SplitDataset):
+        split_keys = torch.as_tensor(dataset.keys, dtype=torch.long)
+        keys = split_keys if keys is None else split_keys[keys]
+        dataset = dataset.underlying_dataset
+
+    if not isinstance(dataset, torch.utils.data.TensorDataset):
+        return None
+
+    tensors = dataset.tensors
+    def fetch(indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        if keys is not None:
+            indices = keys[indices]
+        return [tensor[indices] for tensor in tensors]
+    return fetch
+
+def _make_batch_sampler(dataset, weights, batch_size):
+    # The sampler gets its own generator, seeded from the global RNG when the
+    # loader is built, so that a resumed run can replay it to the same point.
+    generator = torch.Generator()
+    generator.manual_seed(int(torch.randint(2**62, ()).item()))
+
+    if weights is not None:
+        sampler = torch.utils.data.WeightedRandomSampler(weights,
+            replacement=True,
+            num_samples=batch_size,
+            generator=generator)
+    else:
+        sampler = torch.utils.data.RandomSampler(dataset,
+            replacement=True,
+            generator=generator)
+
+    return torch.utils.data.BatchSampler(
+        sampler,
+        batch_size=batch_size,
+        drop_last=True)
+
 class InfiniteDataLoader:
-    def __init__(self, dataset, weights, batch_size, num_workers):
+    """
+    Yields an infinite stream of minibatches sampled with replacement. To
+    resume a run, skip_batches minibatches are drawn by the sampler and
+    discarded without being loaded.
+    """
+    def __init__(self, dataset, weights, batch_size, num_workers,
+                 skip_batches=0):
         super().__init__()
 
-        if weights is not None:
-            sampler = torch.utils.data.WeightedRandomSampler(weights,
-                replacement=True,
-                num_samples=batch_size)
+        batch_sampler = _InfiniteSampler(
+            _make_batch_sampler(dataset, weights, batch_size), skip_batches)
+
+        fetch = _tensor_batch_fetcher(dataset)
+        if fetch is not None:
+            self._infinite_iterator = map(fetch, iter(batch_sampler))
         else:
-            sampler = torch.utils.data.RandomSampler(dataset,
-                replacement=True)
+            self._infinite_iterator = iter(torch.utils.data.DataLoader(
+                dataset,
+                num_workers=num_workers,
+                batch_sampler=batch_sampler
+            ))
 
-        if weights == None:
-            weights = torch.ones(len(dataset))
+    def __iter__(self):
+        while True:
+            yield next(self._infinite_iterator)
 
-        batch_sampler = torch.utils.data.BatchSampler(
-            sampler,
-            batch_size=batch_size,
-            drop_last=True)
+    def __len__(self):
+        raise ValueError
 
-        self._infinite_iterator = iter(torch.utils.data.DataLoader(
-            dataset,
-            num_workers=num_workers,
-            batch_sampler=_InfiniteSampler(batch_sampler)
-        ))
+class _MultiEnvSampler(torch.utils.data.Sampler):
+    """Yields, forever, a tuple with the next batch of indices of every
+    environment."""
+    def __init__(self, batch_samplers, skip=0):
+        self.batch_samplers = batch_samplers
+        self.skip = skip
+
+    def __iter__(self):
+        iterators = [iter(_InfiniteSampler(batch_sampler, self.skip))
+            for batch_sampler in self.batch_samplers]
+        while True:
+            yield tuple(next(iterator) for iterator in iterators)
+
+class _MultiEnvDataset(torch.utils.data.Dataset):
+    """Maps a tuple of per-environment batches of indices to the list of
+    collated (x, y) minibatches."""
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    def __getitem__(self, indices):
+        return [torch.utils.data.dataloader.default_collate(
+                    [dataset[i] for i in env_indices])
+                for dataset, env_indices in zip(self.datasets, indices)]
+
+class MultiEnvInfiniteDataLoader:
+    """
+    Like one InfiniteDataLoader per environment zipped together, but sharing a
+    single pool of num_workers worker processes: each worker loads the
+    minibatches of all environments for a given step.
+    """
+    def __init__(self, datasets, weights, batch_size, num_workers,
+                 skip_batches=0):
+        super().__init__()
+
+        batch_samplers = _MultiEnvSampler(
+            [_make_batch_sampler(dataset, env_weights, batch_size)
+                for dataset, env_weights in zip(datasets, weights)],
+            skip_batches)
+
+        fetches = [_tensor_batch_fetcher(dataset) for dataset in datasets]
+        if all(fetch is not None for fetch in fetches):
+            self._infinite_iterator = map(
+                lambda indices: [fetch(env_indices)
+                    for fetch, env_indices in zip(fetches, indices)],
+                iter(batch_samplers))
+        else:
+            self._infinite_iterator = iter(torch.utils.data.DataLoader(
+                _MultiEnvDataset(datasets),
+                num_workers=num_workers,
+                sampler=batch_samplers,
+                batch_size=None
+            ))
 
     def __iter__(self):
         while True:
@@ -45,23 +159,72 @@ class InfiniteDataLoader:
     def __len__(self):
         raise ValueError
 
-class FastDataLoader:
-    """DataLoader wrapper with slightly improved speed by not respawning worker
-    processes at every epoch."""
-    def __init__(self, dataset, batch_size, num_workers):
+class _IndexedConcatDataset(torch.utils.data.Dataset):
+    """Concatenation of datasets, whose samples are (x, y, index) where index
+    is the position of the sample in the concatenation."""
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.offsets = _offsets(datasets)
+
+    def __getitem__(self, index):
+        i = bisect.bisect_right(self.offsets, index) - 1
+        x, y = self.datasets[i][index - self.offsets[i]]
+        return x, y, index
+
+    def __len__(self):
+        return self.offsets[-1]
+
+def _offsets(datasets):
+    offsets = [0]
+    for dataset in datasets:
+        offsets.append(offsets[-1] + len(dataset))
+    return offsets
+
+def _concat_batch_fetcher(datasets):
+    """Like _tensor_batch_fetcher, for the (x, y, index) batches of an
+    _IndexedConcatDataset of datasets, given ascending indices."""
+    fetches = [_tensor_batch_fetcher(dataset) for dataset in datasets]
+    if any(fetch is None for fetch in fetches):
+        return None
+
+    offsets = torch.tensor(_offsets(datasets))
+    def fetch(indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        # Consecutive indices only span a few datasets
+        bounds = torch.searchsorted(indices, offsets).tolist()
+        parts = [fetches[i](indices[start:end] - offsets[i])
+            for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+            if end > start]
+        return [torch.cat(tensors) for tensors in zip(*parts)] + [indices]
+    return fetch
+
+class ConcatDataLoader:
+    """
+    Reads several datasets one after the other through a single loader and a
+    single pool of workers, in batches which may span consecutive datasets,
+    without respawning worker processes at every epoch. Yields (x, y, index)
+    batches, where index is the position of each sample in the concatenation
+    of the datasets.
+    """
+    def __init__(self, datasets, batch_size, num_workers):
         super().__init__()
 
         batch_sampler = torch.utils.data.BatchSampler(
-            torch.utils.data.RandomSampler(dataset, replacement=False),
+            torch.utils.data.SequentialSampler(range(sum(map(len, datasets)))),
             batch_size=batch_size,
             drop_last=False
         )
 
-        self._infinite_iterator = iter(torch.utils.data.DataLoader(
-            dataset,
-            num_workers=num_workers,
-            batch_sampler=_InfiniteSampler(batch_sampler)
-        ))
+        fetch = _concat_batch_fetcher(datasets)
+        if fetch is not None:
+            self._infinite_iterator = map(fetch,
+                iter(_InfiniteSampler(batch_sampler)))
+        else:
+            self._infinite_iterator = iter(torch.utils.data.DataLoader(
+                _IndexedConcatDataset(datasets),
+                num_workers=num_workers,
+                batch_sampler=_InfiniteSampler(batch_sampler)
+            ))
 
         self._length = len(batch_sampler)
 
@@ -71,3 +234,67 @@ class FastDataLoader:
 
     def __len__(self):
         return self._length
+
+class DevicePrefetcher:
+    """
+    Wraps a loader so that every batch (a tensor, or a list or tuple of them)
+    arrives already on device. On CUDA, the next batch is pinned and copied on
+    a side stream while the current one is being used, overlapping the copies
+    with compute. wait_time accumulates the seconds spent waiting for the
+    wrapped loader, and copy_time those spent pinning batches and issuing
+    their copies.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.wait_time = 0.
+        self.copy_time = 0.
+        if self.device.type == "cuda":
+            self._stream = torch.cuda.Stream(device=self.device)
+        else:
+            self._stream = None
+
+    def _to_device(self, batch):
+        if torch.is_tensor(batch):
+            if self._stream is None:
+                return batch.to(self.device)
+            if not batch.is_pinned():
+                batch = batch.pin_memory()
+            return batch.to(self.device, non_blocking=True)
+        return type(batch)(self._to_device(item) for item in batch)
+
+    def _record_stream(self, batch):
+        if torch.is_tensor(batch):
+            batch.record_stream(torch.cuda.current_stream(self.device))
+        else:
+            for item in batch:
+                self._record_stream(item)
+
+    def _preload(self, iterator):
+        start_time = time.time()
+        batch = next(iterator, None)
+        self.wait_time += time.time() - start_time
+        if batch is None:
+            return None
+        start_time = time.time()
+        if self._stream is None:
+            batch = self._to_device(batch)
+        else:
+            with torch.cuda.stream(self._stream):
+                batch = self._to_device(batch)
+        self.copy_time += time.time() - start_time
+        return batch
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            if self._stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(self._stream)
+                self._record_stream(next_batch)
+            batch = next_batch
+            next_batch = self._preload(iterator)
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
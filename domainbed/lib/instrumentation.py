@@ -0,0 +1,153 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+"""
+Timing and memory statistics of the training loop.
+"""
+
+import collections
+import contextlib
+import os
+import resource
+import time
+
+import torch
+from torch.optim.optimizer import (register_optimizer_step_post_hook,
+    register_optimizer_step_pre_hook)
+
+
+class PhaseTimer:
+    """
+    Accumulates the time spent in each phase of the training steps. On CUDA,
+    phases are delimited by events recorded on the current stream, so timing
+    them never synchronizes the device; the events are only read by summary(),
+    which waits for the last of them only, so not for the work queued on
+    other streams.
+
+    Besides the phases timed explicitly with phase(), the forward passes of
+    the modules given to watch_forward() and every optimizer step taken
+    during the 'update' phase are timed as 'forward' and 'optimizer'. The
+    remainder of 'update' is reported as 'backward'.
+    """
+    def __init__(self, device):
+        self.use_cuda = torch.device(device).type == "cuda"
+        self._intervals = collections.defaultdict(list)
+        self._starts = {}
+        self._depth = 0
+        self._last_event = None
+        self._hooks = [
+            register_optimizer_step_pre_hook(
+                lambda *_: self._start_nested("optimizer")),
+            register_optimizer_step_post_hook(
+                lambda *_: self._stop_nested("optimizer")),
+        ]
+
+    def _now(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self._last_event = event
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        if self.use_cuda:
+            return start.elapsed_time(end) / 1000.
+        return end - start
+
+    def start(self, phase):
+        self._starts[phase] = self._now()
+
+    def stop(self, phase):
+        self._intervals[phase].append((self._starts.pop(phase), self._now()))
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop(phase)
+
+    def _start_nested(self, phase):
+        # Only time the outermost call, and only inside an update
+        if "update" in self._starts and self._depth == 0:
+            self.start(phase)
+        self._depth += 1
+
+    def _stop_nested(self, phase):
+        self._depth -= 1
+        if self._depth == 0 and phase in self._starts:
+            self.stop(phase)
+
+    def watch_forward(self, module):
+        """Time the forward passes of the children of module."""
+        for child in module.children():
+            self._hooks.append(child.register_forward_pre_hook(
+                lambda *_: self._start_nested("forward")))
+            self._hooks.append(child.register_forward_hook(
+                lambda *_: self._stop_nested("forward")))
+
+    def summary(self):
+        """
+        Return the mean seconds per 'update' phase spent in each phase since
+        the last call, and start over.
+        """
+        if self.use_cuda and self._last_event is not None:
+            # All the events were recorded on the current stream
+            self._last_event.synchronize()
+        totals = {phase: sum(self._elapsed(start, end)
+                             for start, end in intervals)
+                  for phase, intervals in self._intervals.items()}
+        n_steps = max(len(self._intervals["update"]), 1)
+        self._intervals = collections.defaultdict(list)
+
+        times = {phase: total / n_steps for phase, total in totals.items()}
+        times["forward"] = times.get("forward", 0.)
+        times["optimizer"] = times.get("optimizer", 0.)
+        times["backward"] = max(times.pop("update", 0.) - times["forward"]
+                                - times["optimizer"], 0.)
+        return times
+
+    def remove(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+
+def memory_stats(device):
+    """Return the peak memory usage of the process so far, in GB."""
+    # ru_maxrss is in KB on Linux
+    stats = {"peak_rss_gb":
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024. * 1024.)}
+    if torch.device(device).type == "cuda":
+        stats["mem_gb"] = torch.cuda.max_memory_allocated() / (1024. ** 3)
+        stats["mem_reserved_gb"] = (torch.cuda.max_memory_reserved()
+            / (1024. ** 3))
+    else:
+        stats["mem_gb"] = stats["peak_rss_gb"]
+    return stats
+
+
+def start_profiler(device):
+    """Start tracing with torch.profiler, on the GPU too if device is CUDA."""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(device).type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = torch.profiler.profile(activities=activities,
+        record_shapes=True)
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler, path):
+    """
+    Stop profiler, and write its Chrome trace to path.json and a summary of
+    the time spent in each operator to path.txt.
+    """
+    profiler.stop()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.export_chrome_trace(path + ".json")
+    use_cuda = torch.profiler.ProfilerActivity.CUDA in profiler.activities
+    sort_by = "self_cuda_time_total" if use_cuda else "self_cpu_time_total"
+    with open(path + ".txt", "w") as f:
+        f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=50))
@@ -4,19 +4,22 @@
 Things that don't belong anywhere else
 """
 
+import bisect
 import hashlib
 import json
 import os
+import random
 import sys
+import threading
+import time
 from shutil import copyfile
-from collections import OrderedDict, defaultdict
-from numbers import Number
-import operator
+from collections import defaultdict
 
 import numpy as np
 import torch
+import torch.autograd as autograd
+import torch.nn.functional as F
 import tqdm
-from collections import Counter
 
 
 def l2_between_dicts(dict_1, dict_2):
@@ -59,25 +62,30 @@ class MovingAverage:
 
 
 
-def make_weights_for_balanced_classes(dataset):
-    counts = Counter()
-    classes = []
-    for _, y in dataset:
-        y = int(y)
-        counts[y] += 1
-        classes.append(y)
-
-    n_classes = len(counts)
+def get_labels(dataset):
+    """
+    Return the labels of dataset as a 1-D numpy array. Datasets exposing a
+    labels() method, TensorDatasets and ImageFolders provide them without
+    loading any input; other datasets are iterated over.
+    """
+    if hasattr(dataset, 'labels'):
+        return np.asarray(dataset.labels())
+    elif isinstance(dataset, torch.utils.data.TensorDataset):
+        return dataset.tensors[1].numpy()
+    elif hasattr(dataset, 'targets'):
+        return np.asarray(dataset.targets)
+    else:
+        return np.array([int(y) for _, y in dataset])
 
-    weight_per_class = {}
-    for y in counts:
-        weight_per_class[y] = 1 / (counts[y] * n_classes)
+def make_weights_for_balanced_classes(dataset):
+    classes = get_labels(dataset).astype(np.int64)
+    counts = np.bincount(classes)
+    n_classes = np.count_nonzero(counts)
 
-    weights = torch.zeros(len(dataset))
-    for i, y in enumerate(classes):
-        weights[i] = weight_per_class[int(y)]
+    weight_per_class = np.zeros(len(counts))
+    weight_per_class[counts > 0] = 1 / (counts[counts > 0] * n_classes)
 
-    return weights
+    return torch.tensor(weight_per_class[classes], dtype=torch.float32)
 
 def pdb():
     sys.stdout = sys.__stdout__
@@ -92,6 +100,84 @@ def seed_hash(*args):
     args_str = str(args)
     return int(hashlib.md5(args_str.encode("utf-8")).hexdigest(), 16) % (2**31)
 
+def to_floats(values):
+    """
+    Return a list of step statistics, Python numbers or scalar tensors, as
+    floats. Algorithms return their statistics as detached tensors, so that
+    training does not wait for the device at every step; they are copied to
+    the host all at once here.
+    """
+    tensors = [v for v in values if torch.is_tensor(v)]
+    if tensors:
+        device = tensors[-1].device
+        host_values = iter(torch.stack([
+            t.detach().float().reshape(()).to(device) for t in tensors
+        ]).tolist())
+    return [next(host_values) if torch.is_tensor(v) else float(v)
+        for v in values]
+
+def get_rng_state():
+    """Return the state of every random number generator used for training."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': (torch.cuda.get_rng_state_all()
+            if torch.cuda.is_available() else None),
+    }
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def atomic_save(obj, path):
+    """torch.save obj to path, so that readers never see a partial file."""
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class Heartbeat:
+    """
+    Touches the file at path every interval seconds, from a daemon thread,
+    until stop() is called. A job whose heartbeat is older than a few
+    intervals is no longer running, see heartbeat_is_alive().
+    """
+    INTERVAL = 60
+    TIMEOUT = 10 * INTERVAL
+
+    def __init__(self, path, interval=INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._touch()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _touch(self):
+        with open(self.path, 'a'):
+            os.utime(self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._touch()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def heartbeat_is_alive(path, timeout=Heartbeat.TIMEOUT):
+    """Return whether the Heartbeat at path was touched in the last timeout
+    seconds."""
+    try:
+        return time.time() - os.path.getmtime(path) < timeout
+    except FileNotFoundError:
+        return False
+
 def print_separator():
     print("="*80)
 
@@ -119,6 +205,8 @@ class _SplitDataset(torch.utils.data.Dataset):
         return self.underlying_dataset[self.keys[key]]
     def __len__(self):
         return len(self.keys)
+    def labels(self):
+        return get_labels(self.underlying_dataset)[self.keys]
 
 def split_dataset(dataset, n, seed=0):
     """
@@ -149,31 +237,153 @@ def random_pairs_of_minibatches(minibatches):
 
     return pairs
 
-def accuracy(network, loader, weights, device):
-    correct = 0
-    total = 0
-    weights_offset = 0
+def env_gradients(network, minibatches, create_graph=False):
+    """
+    Return the loss of network on each minibatch, and the gradients of these
+    losses with respect to each parameter of network, stacked along a first
+    dimension of size len(minibatches).
+
+    All the minibatches go through a single forward pass. Unless create_graph
+    is set, the gradients of all the minibatches are also computed by a single
+    backward pass, batched over the one-hot gradients of the losses.
+    """
+    all_x = torch.cat([x for x, y in minibatches])
+    all_y = torch.cat([y for x, y in minibatches])
+    losses = F.cross_entropy(network(all_x), all_y, reduction='none')
+    env_losses = torch.stack([loss.mean() for loss in
+        losses.split([len(y) for x, y in minibatches])])
+
+    params = list(network.parameters())
+    if create_graph:
+        grads = [autograd.grad(env_loss, params, create_graph=True)
+            for env_loss in env_losses]
+        return env_losses, [torch.stack(g) for g in zip(*grads)]
+
+    one_hots = torch.eye(len(minibatches), device=env_losses.device,
+        dtype=env_losses.dtype)
+    grads = autograd.grad(env_losses, params, grad_outputs=one_hots,
+        is_grads_batched=True)
+    return env_losses, list(grads)
+
+def to_float_images(x):
+    """
+    Small-image datasets store their images as uint8 to save memory; convert
+    such a batch to floats in [0, 1], ideally once it is on the device. Other
+    batches are returned unchanged.
+    """
+    if x.dtype == torch.uint8:
+        return x.float().div_(255.0)
+    return x
+
+class MetricsAccumulator:
+    """
+    Accumulates on the device, for each of n_splits splits, the weighted
+    accuracy, mean cross-entropy loss, per-class accuracy and expected
+    calibration error (over n_bins confidence bins) of batches of
+    predictions. Nothing is copied to the host until summary() is called.
+    """
+    def __init__(self, n_splits, num_classes, device, n_bins=15):
+        self.n_splits = n_splits
+        self.num_classes = num_classes
+        self.n_bins = n_bins
+        zeros = lambda n: torch.zeros(n_splits * n, device=device)
+        self.total = zeros(1)
+        self.correct = zeros(1)
+        self.loss = zeros(1)
+        self.class_total = zeros(num_classes)
+        self.class_correct = zeros(num_classes)
+        self.bin_total = zeros(n_bins)
+        self.bin_correct = zeros(n_bins)
+        self.bin_confidence = zeros(n_bins)
+
+    def add(self, logits, y, split_ids, weights):
+        """Add the predictions logits for labels y, where split_ids and weights
+        give the split and weight of each sample."""
+        logits = logits.float()
+        if logits.size(1) == 1:
+            logits = logits.view(-1)
+            y = y.view(-1)
+            predictions = logits.gt(0).long()
+            confidence = torch.sigmoid(logits.abs())
+            loss = F.binary_cross_entropy_with_logits(logits, y.float(),
+                reduction='none')
+        else:
+            log_probs = F.log_softmax(logits, dim=1)
+            log_confidence, predictions = log_probs.max(1)
+            confidence = log_confidence.exp()
+            loss = F.nll_loss(log_probs, y, reduction='none')
+        correct = predictions.eq(y).float()
+        bins = (confidence * self.n_bins).long().clamp_(max=self.n_bins - 1)
+        class_ids = split_ids * self.num_classes + y.long()
+        bin_ids = split_ids * self.n_bins + bins
+
+        self.total.index_add_(0, split_ids, weights)
+        self.correct.index_add_(0, split_ids, correct * weights)
+        self.loss.index_add_(0, split_ids, loss * weights)
+        self.class_total.index_add_(0, class_ids, weights)
+        self.class_correct.index_add_(0, class_ids, correct * weights)
+        self.bin_total.index_add_(0, bin_ids, weights)
+        self.bin_correct.index_add_(0, bin_ids, correct * weights)
+        self.bin_confidence.index_add_(0, bin_ids, confidence * weights)
+
+    def summary(self):
+        """Return, for every split, a dict of its metrics. class_acc is NaN
+        for the classes absent from the split."""
+        counters = [self.total, self.correct, self.loss, self.class_total,
+            self.class_correct, self.bin_total, self.bin_correct,
+            self.bin_confidence]
+        # A single copy, and thus synchronization, for all splits
+        counters = torch.cat(counters).double().cpu().split(
+            [len(counter) for counter in counters])
+        (total, correct, loss, class_total, class_correct, bin_total,
+            bin_correct, bin_confidence) = [
+            counter.view(self.n_splits, -1) for counter in counters]
+
+        total = total.view(-1)
+        ece = (bin_confidence - bin_correct).abs().sum(1) / total
+        class_acc = class_correct / class_total
+        return [{'acc': (correct[i, 0] / total[i]).item(),
+                 'loss': (loss[i, 0] / total[i]).item(),
+                 'ece': ece[i].item(),
+                 'class_acc': class_acc[i].tolist()}
+            for i in range(self.n_splits)]
+
+def split_metrics(network, loader, split_ids, n_splits, weights, num_classes,
+                  device, split_names=None):
+    """
+    Return the metrics of network (see MetricsAccumulator) on each of n_splits
+    splits read together, one after the other, by loader, which yields
+    (x, y, index) batches. split_ids[index] is the split of each sample and
+    weights[index] its weight. Given split_names, each batch is labelled for
+    torch.profiler with the names of the splits it covers.
+    """
+    # Where each split ends in the concatenation, known on the host
+    split_ends = torch.bincount(split_ids.cpu(),
+        minlength=n_splits).cumsum(0).tolist()
+    split_ids = split_ids.to(device)
+    weights = weights.to(device)
+    metrics = MetricsAccumulator(n_splits, num_classes, device)
 
     network.eval()
+    offset = 0
     with torch.no_grad():
-        for x, y in loader:
-            x = x.to(device)
-            y = y.to(device)
-            p = network.predict(x)
-            if weights is None:
-                batch_weights = torch.ones(len(x))
+        for x, y, index in loader:
+            if split_names is None:
+                label = 'evaluate'
             else:
-                batch_weights = weights[weights_offset : weights_offset + len(x)]
-                weights_offset += len(x)
-            batch_weights = batch_weights.to(device)
-            if p.size(1) == 1:
-                correct += (p.gt(0).eq(y).float() * batch_weights.view(-1, 1)).sum().item()
-            else:
-                correct += (p.argmax(1).eq(y).float() * batch_weights).sum().item()
-            total += batch_weights.sum().item()
+                first = bisect.bisect_right(split_ends, offset)
+                last = bisect.bisect_right(split_ends, offset + len(x) - 1)
+                label = 'evaluate_' + '+'.join(split_names[first:last + 1])
+            offset += len(x)
+            with torch.profiler.record_function(label):
+                x = to_float_images(x.to(device))
+                y = y.to(device)
+                index = index.to(device)
+                metrics.add(network.predict(x), y, split_ids[index],
+                    weights[index])
     network.train()
 
-    return correct / total
+    return metrics.summary()
 
 class Tee:
     def __init__(self, fname, mode="a"):
@@ -188,39 +398,3 @@ class Tee:
     def flush(self):
         self.stdout.flush()
         self.file.flush()
-
-class ParamDict(OrderedDict):
-    """Code adapted from https://github.com/Alok/rl_implementations/tree/master/reptile.
-    A dictionary where the values are Tensors, meant to represent weights of
-    a model. This subclass lets you perform arithmetic on weights directly."""
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, *kwargs)
-
-    def _prototype(self, other, op):
-        if isinstance(other, Number):
-            return ParamDict({k: op(v, other) for k, v in self.items()})
-        elif isinstance(other, dict):
-            return ParamDict({k: op(self[k], other[k]) for k in self})
-        else:
-            raise NotImplementedError
-
-    def __add__(self, other):
-        return self._prototype(other, operator.add)
-
-    def __rmul__(self, other):
-        return self._prototype(other, operator.mul)
-
-    __mul__ = __rmul__
-
-    def __neg__(self):
-        return ParamDict({k: -v for k, v in self.items()})
-
-    def __rsub__(self, other):
-        # a- b := a + (-b)
-        return self.__add__(other.__neg__())
-
-    __sub__ = __rsub__
-
-    def __truediv__(self, other):
-        return self._prototype(other, operator.truediv)
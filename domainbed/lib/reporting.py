@@ -38,3 +38,26 @@ def get_grouped_records(records):
             result[group].append(r)
     return Q([{"trial_seed": t, "dataset": d, "algorithm": a, "test_env": e,
         "records": Q(r)} for (t,d,a,e),r in result.items()])
+
+def get_phase_times(records):
+    """
+    Average the seconds per step spent in each phase of training, and the
+    seconds per evaluation, over the records of each (dataset, algorithm).
+    data_fraction is the share of the step spent waiting for and copying data:
+    data-bound combinations have a large one. Records without phase timings
+    are skipped; those of compiled runs have NaN forward and backward times,
+    hence a NaN data_fraction.
+    """
+    phases = ["data", "copy", "forward", "backward", "optimizer"]
+    def summarize(group, group_records):
+        dataset, algorithm = group
+        result = {"dataset": dataset, "algorithm": algorithm}
+        for phase in phases + ["step", "eval"]:
+            result[phase + "_time"] = group_records.select(
+                phase + "_time").mean()
+        result["data_fraction"] = (result["data_time"] + result["copy_time"]) \
+            / sum(result[phase + "_time"] for phase in phases)
+        result["mem_gb"] = group_records.select("mem_gb").max()
+        return result
+    return records.filter(lambda r: "forward_time" in r).group(
+        "args.dataset,args.algorithm").map(summarize)
@@ -3,36 +3,123 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import torchvision.models
 
 from domainbed.lib import wide_resnet
 import copy
 
 
+def _resnet_conv_bn_pairs(model):
+    """Yield (parent, conv_name, bn_name) for every convolution of a
+    torchvision ResNet, and the BatchNorm2d which follows it."""
+    yield model, "conv1", "bn1"
+    for layer in [model.layer1, model.layer2, model.layer3, model.layer4]:
+        for block in layer:
+            for name in list(block._modules):
+                if name.startswith("conv"):
+                    yield block, name, "bn" + name[len("conv"):]
+            if isinstance(block.downsample, torch.nn.Sequential):
+                yield block.downsample, "0", "1"
+
+
 def remove_batch_norm_from_resnet(model):
+    """
+    Fuse every BatchNorm2d of a torchvision ResNet into the preceding
+    convolution, for inference. Works on models folded with
+    fold_batch_norm_into_resnet too.
+    """
     fuse = torch.nn.utils.fusion.fuse_conv_bn_eval
     model.eval()
 
-    model.conv1 = fuse(model.conv1, model.bn1)
-    model.bn1 = Identity()
-
-    for name, module in model.named_modules():
-        if name.startswith("layer") and len(name) == 6:
-            for b, bottleneck in enumerate(module):
-                for name2, module2 in bottleneck.named_modules():
-                    if name2.startswith("conv"):
-                        bn_name = "bn" + name2[-1]
-                        setattr(bottleneck, name2,
-                                fuse(module2, getattr(bottleneck, bn_name)))
-                        setattr(bottleneck, bn_name, Identity())
-                if isinstance(bottleneck.downsample, torch.nn.Sequential):
-                    bottleneck.downsample[0] = fuse(bottleneck.downsample[0],
-                                                    bottleneck.downsample[1])
-                    bottleneck.downsample[1] = Identity()
+    for parent, conv_name, bn_name in list(_resnet_conv_bn_pairs(model)):
+        conv = getattr(parent, conv_name)
+        bn = getattr(parent, bn_name)
+        if isinstance(conv, FoldedConvBN2d):
+            setattr(parent, conv_name, conv.fuse())
+        else:
+            setattr(parent, conv_name, fuse(conv, bn))
+        setattr(parent, bn_name, Identity())
     model.train()
     return model
 
 
+def fold_batch_norm_into_resnet(model):
+    """
+    Fold every BatchNorm2d of a torchvision ResNet, whose statistics must stay
+    frozen, into the preceding convolution for training (see FoldedConvBN2d).
+    state_dict() keys are unchanged.
+    """
+    for parent, conv_name, bn_name in list(_resnet_conv_bn_pairs(model)):
+        conv = getattr(parent, conv_name)
+        bn = FoldedBN2d(getattr(parent, bn_name))
+        setattr(parent, conv_name, FoldedConvBN2d(conv, bn))
+        setattr(parent, bn_name, bn)
+    return model
+
+
+def _share_state(dst, src):
+    """Make module dst use the parameters and buffers of module src."""
+    for name, param in src._parameters.items():
+        setattr(dst, name, param)
+    for name, buffer in src._buffers.items():
+        setattr(dst, name, buffer)
+
+
+class FoldedBN2d(nn.BatchNorm2d):
+    """
+    A BatchNorm2d with frozen statistics, folded into the preceding
+    FoldedConvBN2d: it only holds its parameters and statistics, and passes
+    its input through unchanged.
+    """
+    def __init__(self, bn):
+        super(FoldedBN2d, self).__init__(bn.num_features, bn.eps,
+            bn.momentum, bn.affine, bn.track_running_stats, device="meta")
+        _share_state(self, bn)
+
+    def forward(self, x):
+        return x
+
+
+class FoldedConvBN2d(nn.Conv2d):
+    """
+    A Conv2d followed by a FoldedBN2d, computed as a single convolution. The
+    BN is folded into the weight and bias of the convolution at every
+    forward, so that the gradients still reach the parameters of both.
+    """
+    def __init__(self, conv, bn):
+        super(FoldedConvBN2d, self).__init__(conv.in_channels,
+            conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+            conv.dilation, conv.groups, bias=False,
+            padding_mode=conv.padding_mode, device="meta")
+        _share_state(self, conv)
+        # A tuple, so that bn is not registered as a submodule twice
+        self._bn = (bn,)
+
+    def folded_weight_and_bias(self):
+        bn = self._bn[0]
+        scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+        weight = self.weight * scale.view(-1, 1, 1, 1)
+        bias = bn.bias - bn.running_mean * scale
+        if self.bias is not None:
+            bias = bias + self.bias * scale
+        return weight, bias
+
+    def forward(self, x):
+        return self._conv_forward(x, *self.folded_weight_and_bias())
+
+    def fuse(self):
+        """Return a plain Conv2d computing the same function, for inference."""
+        weight, bias = self.folded_weight_and_bias()
+        conv = nn.Conv2d(self.in_channels, self.out_channels,
+            self.kernel_size, self.stride, self.padding, self.dilation,
+            self.groups, bias=True, padding_mode=self.padding_mode,
+            device=weight.device, dtype=weight.dtype)
+        conv.weight = nn.Parameter(weight.detach())
+        conv.bias = nn.Parameter(bias.detach())
+        return conv
+
+
 class Identity(nn.Module):
     """An identity layer"""
     def __init__(self):
@@ -77,8 +164,6 @@ class ResNet(torch.nn.Module):
             self.network = torchvision.models.resnet50(pretrained=True)
             self.n_outputs = 2048
 
-        # self.network = remove_batch_norm_from_resnet(self.network)
-
         # adapt number of channels
         nc = input_shape[0]
         if nc != 3:
@@ -95,12 +180,37 @@ class ResNet(torch.nn.Module):
         del self.network.fc
         self.network.fc = Identity()
 
+        if hparams.get('resnet_fold_bn', False):
+            # The BN statistics are frozen (see freeze_bn), so each BN can be
+            # computed as part of the preceding convolution.
+            fold_batch_norm_into_resnet(self.network)
+
         self.freeze_bn()
         self.hparams = hparams
         self.dropout = nn.Dropout(hparams['resnet_dropout'])
 
+        self.checkpoint_segments = hparams.get('resnet_checkpoint_segments', 0)
+        if not 0 <= self.checkpoint_segments <= len(self._layers()):
+            raise ValueError('resnet_checkpoint_segments must be 0, or '
+                'between 1 and {}; got {}'.format(len(self._layers()),
+                self.checkpoint_segments))
+
+    def _layers(self):
+        """The layers of the network, in the order of its forward pass."""
+        net = self.network
+        return [net.conv1, net.bn1, net.relu, net.maxpool, net.layer1,
+            net.layer2, net.layer3, net.layer4, net.avgpool, nn.Flatten(1),
+            net.fc]
+
     def forward(self, x):
         """Encode x into a feature vector of size n_outputs."""
+        if (self.checkpoint_segments and self.training
+                and torch.is_grad_enabled()):
+            # Only keep the activations at the boundaries of the segments,
+            # and recompute the others during the backward pass
+            return self.dropout(torch.utils.checkpoint.checkpoint_sequential(
+                self._layers(), self.checkpoint_segments, x,
+                use_reentrant=False))
         return self.dropout(self.network(x))
 
     def train(self, mode=True):
@@ -162,7 +272,7 @@ class MNIST_CNN(nn.Module):
 
 
 class ContextNet(nn.Module):
-    def __init__(self, input_shape):
+    def __init__(self, input_shape, hparams):
         super(ContextNet, self).__init__()
 
         # Keep same dimensions
@@ -177,23 +287,50 @@ class ContextNet(nn.Module):
             nn.Conv2d(64, 1, 5, padding=padding),
         )
 
+        if hparams.get('channels_last', False):
+            to_channels_last(self)
+
     def forward(self, x):
         return self.context_net(x)
 
 
+def _inputs_to_channels_last(module, inputs):
+    return tuple(x.contiguous(memory_format=torch.channels_last)
+        if torch.is_tensor(x) and x.dim() == 4 else x for x in inputs)
+
+
+def to_channels_last(module):
+    """
+    Convert the weights of module to the channels_last memory format, and
+    make it convert its image inputs too, so that its convolutions run on
+    NHWC tensors, which oneDNN on CPUs (and tensor cores on GPUs) prefer.
+    """
+    module.to(memory_format=torch.channels_last)
+    module.register_forward_pre_hook(_inputs_to_channels_last)
+    return module
+
+
 def Featurizer(input_shape, hparams):
     """Auto-select an appropriate featurizer for the given input shape."""
     if len(input_shape) == 1:
-        return MLP(input_shape[0], hparams["mlp_width"], hparams)
+        featurizer = MLP(input_shape[0], hparams["mlp_width"], hparams)
     elif input_shape[1:3] == (28, 28):
-        return MNIST_CNN(input_shape)
+        featurizer = MNIST_CNN(input_shape)
     elif input_shape[1:3] == (32, 32):
-        return wide_resnet.Wide_ResNet(input_shape, 16, 2, 0.)
+        featurizer = wide_resnet.Wide_ResNet(input_shape, 16, 2, 0.)
     elif input_shape[1:3] == (224, 224):
-        return ResNet(input_shape, hparams)
+        featurizer = ResNet(input_shape, hparams)
     else:
         raise NotImplementedError
 
+    if hparams.get('channels_last', False) and len(input_shape) == 3:
+        to_channels_last(featurizer)
+
+    if hparams.get('compile', False):
+        # Compiles forward() in place, leaving state_dict() keys unchanged
+        featurizer.compile()
+    return featurizer
+
 
 def Classifier(in_features, out_features, is_nonlinear=False):
     if is_nonlinear:
@@ -221,8 +358,5 @@ class WholeFish(nn.Module):
         if weights is not None:
             self.load_state_dict(copy.deepcopy(weights))
 
-    def reset_weights(self, weights):
-        self.load_state_dict(copy.deepcopy(weights))
-
     def forward(self, x):
         return self.net(x)
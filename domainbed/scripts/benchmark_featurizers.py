@@ -0,0 +1,83 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+"""
+Benchmark the image featurizers in the default (NCHW) and channels_last
+(NHWC) memory formats, e.g. to decide whether to set
+hparams['channels_last'] on a given kind of node:
+
+    python -m domainbed.scripts.benchmark_featurizers --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from domainbed import hparams_registry
+from domainbed import networks
+from domainbed.lib import misc
+
+# Input shape, and hparams selecting the featurizer
+ARCHITECTURES = {
+    'MNIST_CNN': ((2, 28, 28), {}),
+    'Wide_ResNet': ((3, 32, 32), {}),
+    'ResNet-18': ((3, 224, 224), {'resnet18': True}),
+    'ResNet-50': ((3, 224, 224), {'resnet18': False}),
+}
+
+
+def benchmark(featurizer, x, train, n_warmup, n_iters):
+    """Return the mean seconds per forward pass of featurizer on x, and per
+    backward pass too if train."""
+    def run():
+        if train:
+            featurizer(x).sum().backward()
+        else:
+            with torch.no_grad():
+                featurizer(x)
+
+    def synchronize():
+        if x.is_cuda:
+            torch.cuda.synchronize()
+
+    featurizer.train(train)
+    for _ in range(n_warmup):
+        run()
+    synchronize()
+    start_time = time.perf_counter()
+    for _ in range(n_iters):
+        run()
+    synchronize()
+    return (time.perf_counter() - start_time) / n_iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark featurizers')
+    parser.add_argument('--device', type=str,
+        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--architectures', nargs='+', type=str,
+        default=list(ARCHITECTURES.keys()), choices=list(ARCHITECTURES.keys()))
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--n_warmup', type=int, default=3)
+    parser.add_argument('--n_iters', type=int, default=10)
+    args = parser.parse_args()
+
+    misc.print_row(['architecture', 'mode', 'nchw_ms', 'nhwc_ms', 'speedup'],
+        colwidth=12)
+    for architecture in args.architectures:
+        input_shape, architecture_hparams = ARCHITECTURES[architecture]
+        x = torch.randn(args.batch_size, *input_shape, device=args.device)
+        for train in [True, False]:
+            times = []
+            for channels_last in [False, True]:
+                hparams = hparams_registry.default_hparams('ERM',
+                    'RotatedMNIST')
+                hparams.update(architecture_hparams)
+                hparams['channels_last'] = channels_last
+                featurizer = networks.Featurizer(input_shape, hparams)
+                featurizer.to(args.device)
+                times.append(benchmark(featurizer, x, train, args.n_warmup,
+                    args.n_iters))
+            misc.print_row([architecture, 'train' if train else 'eval',
+                1000 * times[0], 1000 * times[1], times[0] / times[1]],
+                colwidth=12)
@@ -8,6 +8,7 @@ import torch
 import argparse
 from domainbed import hparams_registry
 from domainbed import datasets
+from domainbed.lib import misc
 import imageio
 import os
 from tqdm import tqdm
@@ -34,6 +35,7 @@ if __name__ == '__main__':
                 while y > 10:
                     idx = random.choice(list(range(len(env))))
                     x, y = env[idx]
+                x = misc.to_float_images(x)
                 if x.shape[0] == 2:
                     x = torch.cat([x, torch.zeros_like(x)], dim=0)[:3,:,:]
                 if x.min() < 0:
@@ -30,6 +30,7 @@ import shlex
 class Job:
     NOT_LAUNCHED = 'Not launched'
     INCOMPLETE = 'Incomplete'
+    RESUMABLE = 'Resumable'
     DONE = 'Done'
 
     def __init__(self, train_args, sweep_output_dir):
@@ -50,6 +51,12 @@ class Job:
 
         if os.path.exists(os.path.join(self.output_dir, 'done')):
             self.state = Job.DONE
+        elif (os.path.exists(os.path.join(self.output_dir, 'checkpoint.pkl'))
+                and not misc.heartbeat_is_alive(
+                    os.path.join(self.output_dir, 'heartbeat'))):
+            # Running jobs write checkpoints too, but keep their heartbeat
+            # fresh; only the checkpoints of dead jobs are resumed.
+            self.state = Job.RESUMABLE
         elif os.path.exists(self.output_dir):
             self.state = Job.INCOMPLETE
         else:
@@ -84,6 +91,13 @@ class Job:
             shutil.rmtree(job.output_dir)
         print(f'Deleted {len(jobs)} jobs!')
 
+def jobs_to_launch(jobs):
+    """
+    Return the jobs to launch: those never launched, and those whose run died
+    after leaving a checkpoint, which they resume from when relaunched.
+    """
+    return [j for j in jobs if j.state in (Job.NOT_LAUNCHED, Job.RESUMABLE)]
+
 def all_test_env_combinations(n):
     """
     For a dataset with n >= 3 envs, return all combinations of 1 and 2 test
@@ -173,15 +187,16 @@ if __name__ == "__main__":
 
     for job in jobs:
         print(job)
-    print("{} jobs: {} done, {} incomplete, {} not launched.".format(
+    print("{} jobs: {} done, {} resumable, {} incomplete, {} not launched.".format(
         len(jobs),
         len([j for j in jobs if j.state == Job.DONE]),
+        len([j for j in jobs if j.state == Job.RESUMABLE]),
         len([j for j in jobs if j.state == Job.INCOMPLETE]),
         len([j for j in jobs if j.state == Job.NOT_LAUNCHED]))
     )
 
     if args.command == 'launch':
-        to_launch = [j for j in jobs if j.state == Job.NOT_LAUNCHED]
+        to_launch = jobs_to_launch(jobs)
         print(f'About to launch {len(to_launch)} jobs.')
         if not args.skip_confirmation:
             ask_for_confirmation()
@@ -2,6 +2,7 @@
 
 import argparse
 import collections
+import concurrent.futures
 import json
 import os
 import random
@@ -19,7 +20,10 @@ from domainbed import datasets
 from domainbed import hparams_registry
 from domainbed import algorithms
 from domainbed.lib import misc
-from domainbed.lib.fast_data_loader import InfiniteDataLoader, FastDataLoader
+from domainbed.lib import instrumentation
+from domainbed.lib.fast_data_loader import (
+    MultiEnvInfiniteDataLoader, ConcatDataLoader, DevicePrefetcher
+)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Domain generalization')
@@ -48,17 +52,47 @@ if __name__ == "__main__":
         help="For domain adaptation, % of test to use unlabeled for training.")
     parser.add_argument('--skip_model_save', action='store_true')
     parser.add_argument('--save_model_every_checkpoint', action='store_true')
+    parser.add_argument('--resume_checkpoint_freq', type=int, default=None,
+        help='Save the full training state every N steps, to resume from '
+        'if the job is preempted. Default is checkpoint_freq, 0 disables.')
+    parser.add_argument('--async_eval', action='store_true',
+        help='Evaluate checkpoints in the background while training goes on.')
+    parser.add_argument('--compile_cache_dir', type=str, default=None,
+        help='Directory of the torch.compile cache, to share compiled '
+        'kernels between jobs when hparams["compile"] is set. Default is '
+        'the per-host inductor cache.')
+    parser.add_argument('--profile', action='store_true',
+        help='Trace a window of steps with torch.profiler into '
+        'output_dir/profile.')
+    parser.add_argument('--profile_start', type=int, default=None,
+        help='First step to trace. Default is checkpoint_freq, so that the '
+        'window starts with an evaluation.')
+    parser.add_argument('--profile_steps', type=int, default=3,
+        help='Number of steps to trace.')
     args = parser.parse_args()
 
-    # If we ever want to implement checkpointing, just persist these values
-    # every once in a while, and then load them from disk here.
     start_step = 0
     algorithm_dict = None
+    resume_dict = None
 
     os.makedirs(args.output_dir, exist_ok=True)
     sys.stdout = misc.Tee(os.path.join(args.output_dir, 'out.txt'))
     sys.stderr = misc.Tee(os.path.join(args.output_dir, 'err.txt'))
 
+    # Tells `sweep launch` that this job is still running, so that it does
+    # not resume it from its checkpoint.
+    heartbeat = misc.Heartbeat(os.path.join(args.output_dir, 'heartbeat'))
+
+    # A preempted run leaves a checkpoint of its full training state behind,
+    # from which we pick up where it stopped.
+    resume_path = os.path.join(args.output_dir, 'checkpoint.pkl')
+    if os.path.exists(resume_path):
+        resume_dict = torch.load(resume_path, map_location='cpu',
+            weights_only=False)
+        start_step = resume_dict['step'] + 1
+        algorithm_dict = resume_dict['model_dict']
+        print('Resuming from step {}'.format(start_step))
+
     print("Environment:")
     print("\tPython: {}".format(sys.version.split(" ")[0]))
     print("\tPyTorch: {}".format(torch.__version__))
@@ -84,6 +118,12 @@ if __name__ == "__main__":
     for k, v in sorted(hparams.items()):
         print('\t{}: {}'.format(k, v))
 
+    if hparams.get('compile', False):
+        if args.compile_cache_dir is not None:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = args.compile_cache_dir
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
+
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -143,28 +183,44 @@ if __name__ == "__main__":
     if args.task == "domain_adaptation" and len(uda_splits) == 0:
         raise ValueError("Not enough unlabeled samples for domain adaptation.")
 
-    train_loaders = [InfiniteDataLoader(
-        dataset=env,
-        weights=env_weights,
-        batch_size=hparams['batch_size'],
-        num_workers=dataset.N_WORKERS)
+    train_envs = [(env, env_weights)
         for i, (env, env_weights) in enumerate(in_splits)
         if i not in args.test_envs]
 
-    uda_loaders = [InfiniteDataLoader(
-        dataset=env,
-        weights=env_weights,
-        batch_size=hparams['batch_size'],
-        num_workers=dataset.N_WORKERS)
+    uda_envs = [(env, env_weights)
         for i, (env, env_weights) in enumerate(uda_splits)
         if i in args.test_envs]
 
-    eval_loaders = [FastDataLoader(
-        dataset=env,
-        batch_size=64,
-        num_workers=dataset.N_WORKERS)
-        for env, _ in (in_splits + out_splits + uda_splits)]
+    # A single pool of workers loads the minibatches of all environments, and
+    # their copies to the device overlap with the previous step.
+    train_loader = DevicePrefetcher(MultiEnvInfiniteDataLoader(
+        datasets=[env for env, _ in train_envs],
+        weights=[env_weights for _, env_weights in train_envs],
+        batch_size=hparams['batch_size'],
+        num_workers=dataset.N_WORKERS,
+        skip_batches=start_step), device)
+
+    if args.task == "domain_adaptation":
+        uda_loader = DevicePrefetcher(MultiEnvInfiniteDataLoader(
+            datasets=[env for env, _ in uda_envs],
+            weights=[env_weights for _, env_weights in uda_envs],
+            batch_size=hparams['batch_size'],
+            num_workers=dataset.N_WORKERS,
+            skip_batches=start_step), device)
+
+    # All eval splits are read, one after the other, by a single loader.
+    eval_splits = [env for env, _ in (in_splits + out_splits + uda_splits)]
     eval_weights = [None for _, weights in (in_splits + out_splits + uda_splits)]
+    eval_loader = DevicePrefetcher(ConcatDataLoader(
+        datasets=eval_splits,
+        batch_size=64,
+        num_workers=dataset.N_WORKERS), device)
+    eval_split_ids = torch.cat([torch.full((len(env),), i, dtype=torch.long)
+        for i, env in enumerate(eval_splits)])
+    eval_sample_weights = torch.cat([
+        torch.ones(len(env)) if weights is None
+        else torch.as_tensor(weights, dtype=torch.float)
+        for env, weights in zip(eval_splits, eval_weights)])
     eval_loader_names = ['env{}_in'.format(i)
         for i in range(len(in_splits))]
     eval_loader_names += ['env{}_out'.format(i)
@@ -181,14 +237,36 @@ if __name__ == "__main__":
 
     algorithm.to(device)
 
-    train_minibatches_iterator = zip(*train_loaders)
-    uda_minibatches_iterator = zip(*uda_loaders)
+    # Times the forward, backward and optimizer phases of every update
+    timer = instrumentation.PhaseTimer(device)
+    if hparams.get('compile', False):
+        # Besides the featurizer, compile predict(), which most updates call
+        # for their forward pass. Forward hooks would break the graphs, so
+        # forwards are not timed, and neither the forward nor the backward
+        # time is reported.
+        algorithm.predict = torch.compile(algorithm.predict)
+    else:
+        timer.watch_forward(algorithm)
+
+    train_minibatches_iterator = iter(train_loader)
+    if args.task == "domain_adaptation":
+        uda_minibatches_iterator = iter(uda_loader)
     checkpoint_vals = collections.defaultdict(lambda: [])
 
     steps_per_epoch = min([len(env)/hparams['batch_size'] for env,_ in in_splits])
 
     n_steps = args.steps or dataset.N_STEPS
     checkpoint_freq = args.checkpoint_freq or dataset.CHECKPOINT_FREQ
+    if args.resume_checkpoint_freq is None:
+        resume_checkpoint_freq = checkpoint_freq
+    else:
+        resume_checkpoint_freq = args.resume_checkpoint_freq
+    if args.profile_start is None:
+        profile_start = checkpoint_freq
+    else:
+        profile_start = args.profile_start
+    profile_dir = os.path.join(args.output_dir, 'profile')
+    epochs_path = os.path.join(args.output_dir, 'results.jsonl')
 
     def save_checkpoint(filename):
         if args.skip_model_save:
@@ -203,64 +281,226 @@ if __name__ == "__main__":
         }
         torch.save(save_dict, os.path.join(args.output_dir, filename))
 
+    def checkpoint_floats():
+        """Return checkpoint_vals with floats for values, copying all the
+        tensors among them to the host at once."""
+        values = iter(misc.to_floats(
+            [v for val in checkpoint_vals.values() for v in val]))
+        return {key: [next(values) for _ in val]
+            for key, val in checkpoint_vals.items()}
+
+    def save_resume_checkpoint(step):
+        save_dict = {
+            "step": step,
+            "model_dict": algorithm.state_dict(),
+            "training_state": algorithm.training_state_dict(),
+            "rng_state": misc.get_rng_state(),
+            "checkpoint_vals": checkpoint_floats(),
+            # Checkpoints whose evaluation had not finished yet
+            "pending_results": [results for results, _ in pending_evals]
+        }
+        misc.atomic_save(save_dict, resume_path)
+
+    def evaluate(eval_algorithm):
+        """Return the metrics of eval_algorithm on every eval split."""
+        eval_start_time = time.time()
+        with torch.profiler.record_function('evaluate'), \
+                eval_algorithm.autocast(device):
+            metrics = misc.split_metrics(eval_algorithm, eval_loader,
+                eval_split_ids, len(eval_loader_names), eval_sample_weights,
+                dataset.num_classes, device, split_names=eval_loader_names)
+        eval_results = {'class_acc': {}}
+        for name, split_metrics in zip(eval_loader_names, metrics):
+            eval_results[name+'_acc'] = split_metrics['acc']
+            eval_results[name+'_loss'] = split_metrics['loss']
+            eval_results[name+'_ece'] = split_metrics['ece']
+            eval_results['class_acc'][name] = split_metrics['class_acc']
+        eval_results['eval_time'] = time.time() - eval_start_time
+        return eval_results
 
     last_results_keys = None
+    def write_results(results):
+        global last_results_keys
+        results.update(instrumentation.memory_stats(device))
+        if hparams.get('compile', False):
+            results['graph_breaks'] = sum(
+                torch._dynamo.utils.counters['graph_break'].values())
+        # Per-class accuracies are nested, so they are not printed
+        class_acc = results.pop('class_acc')
+
+        results_keys = sorted(results.keys())
+        if results_keys != last_results_keys:
+            misc.print_row(results_keys, colwidth=12)
+            last_results_keys = results_keys
+        misc.print_row([results[key] for key in results_keys],
+            colwidth=12)
+
+        results.update({
+            'class_acc': class_acc,
+            'hparams': hparams,
+            'args': vars(args)
+        })
+
+        with open(epochs_path, 'a') as f:
+            f.write(json.dumps(results, sort_keys=True) + "\n")
+
+    # With --async_eval, checkpoints are evaluated by a background thread on
+    # a replica of the algorithm, loaded with a snapshot of its weights, while
+    # training goes on. The evaluations run on their own CUDA stream. Each one
+    # overlaps with the training steps up to the next checkpoint, which waits
+    # for it to finish: evaluations run one at a time, and at most one
+    # snapshot is held.
+    pending_evals = collections.deque()
+    if args.async_eval:
+        # Initializing the replica must not change the RNG state of training
+        with torch.random.fork_rng():
+            eval_algorithm = algorithm_class(dataset.input_shape,
+                dataset.num_classes, len(dataset) - len(args.test_envs),
+                hparams)
+        eval_algorithm.to(device)
+        if hparams.get('compile', False):
+            eval_algorithm.predict = torch.compile(eval_algorithm.predict)
+        eval_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if device == "cuda":
+            eval_stream = torch.cuda.Stream()
+
+    def evaluate_snapshot(snapshot, snapshot_ready):
+        if device != "cuda":
+            eval_algorithm.load_state_dict(snapshot)
+            return evaluate(eval_algorithm)
+        with torch.cuda.stream(eval_stream):
+            eval_stream.wait_event(snapshot_ready)
+            eval_algorithm.load_state_dict(snapshot)
+            accs = evaluate(eval_algorithm)
+            # The snapshot may only be freed once its last reader is done
+            eval_stream.synchronize()
+        return accs
+
+    def submit_eval(results):
+        snapshot = {k: v.detach().clone()
+            for k, v in algorithm.state_dict().items()}
+        snapshot_ready = None
+        if device == "cuda":
+            snapshot_ready = torch.cuda.Event()
+            snapshot_ready.record()
+        future = eval_executor.submit(evaluate_snapshot, snapshot,
+            snapshot_ready)
+        pending_evals.append((results, future))
+
+    def join_evals(before_step=-1):
+        """Write the results of the finished evaluations in step order,
+        first waiting for those of the checkpoints before before_step."""
+        while pending_evals and (pending_evals[0][0]['step'] < before_step
+                                 or pending_evals[0][1].done()):
+            results, future = pending_evals.popleft()
+            results.update(future.result())
+            write_results(results)
+
+    if resume_dict is not None:
+        # Drop the results the preempted run wrote after its checkpoint, and
+        # evaluate the checkpoint itself if that had not finished.
+        written_steps = set()
+        if os.path.exists(epochs_path):
+            with open(epochs_path, 'r') as f:
+                lines = [line for line in f
+                    if json.loads(line)['step'] < start_step]
+            with open(epochs_path, 'w') as f:
+                f.writelines(lines)
+            written_steps = set(json.loads(line)['step'] for line in lines)
+        for results in resume_dict['pending_results']:
+            if results['step'] not in written_steps:
+                results.update(evaluate(algorithm))
+                write_results(results)
+
+        algorithm.load_training_state_dict(resume_dict['training_state'])
+        checkpoint_vals.update(resume_dict['checkpoint_vals'])
+        misc.set_rng_state(resume_dict['rng_state'])
+
     for step in range(start_step, n_steps):
-        step_start_time = time.time()
-        minibatches_device = [(x.to(device), y.to(device))
+        profiler = None
+        if args.profile and (profile_start <= step <
+                             profile_start + args.profile_steps):
+            profiler = instrumentation.start_profiler(device)
+        # Timed by the timer rather than the host clock, since nothing waits
+        # for the update to finish on the device
+        timer.start('step')
+        minibatches_device = [(misc.to_float_images(x), y)
             for x,y in next(train_minibatches_iterator)]
+        data_time, copy_time = train_loader.wait_time, train_loader.copy_time
+        train_loader.wait_time, train_loader.copy_time = 0., 0.
         if args.task == "domain_adaptation":
-            uda_device = [x.to(device)
+            uda_device = [misc.to_float_images(x)
                 for x,_ in next(uda_minibatches_iterator)]
+            data_time += uda_loader.wait_time
+            copy_time += uda_loader.copy_time
+            uda_loader.wait_time, uda_loader.copy_time = 0., 0.
         else:
             uda_device = None
-        step_vals = algorithm.update(minibatches_device, uda_device)
-        checkpoint_vals['step_time'].append(time.time() - step_start_time)
+        with timer.phase('update'), \
+                torch.profiler.record_function('update'), \
+                algorithm.autocast(device):
+            step_vals = algorithm.update(minibatches_device, uda_device)
+        timer.stop('step')
+        checkpoint_vals['data_time'].append(data_time)
+        checkpoint_vals['copy_time'].append(copy_time)
 
         for key, val in step_vals.items():
             checkpoint_vals[key].append(val)
 
+        join_evals()
+
         if (step % checkpoint_freq == 0) or (step == n_steps - 1):
             results = {
                 'step': step,
                 'epoch': step / steps_per_epoch,
             }
 
-            for key, val in checkpoint_vals.items():
+            for key, val in checkpoint_floats().items():
                 results[key] = np.mean(val)
+            for phase, phase_time in timer.summary().items():
+                results[phase + '_time'] = phase_time
+            if hparams.get('compile', False):
+                results['forward_time'] = float('nan')
+                results['backward_time'] = float('nan')
+
+            if args.async_eval:
+                # Waits for the evaluation of the previous checkpoint
+                join_evals(before_step=step)
+                submit_eval(results)
+            else:
+                results.update(evaluate(algorithm))
+                write_results(results)
 
-            evals = zip(eval_loader_names, eval_loaders, eval_weights)
-            for name, loader, weights in evals:
-                acc = misc.accuracy(algorithm, loader, weights, device)
-                results[name+'_acc'] = acc
-
-            # results['mem_gb'] = torch.cuda.max_memory_allocated() / (1024.*1024.*1024.)
-            results['mem_gb'] = 20
+            checkpoint_vals = collections.defaultdict(lambda: [])
 
-            results_keys = sorted(results.keys())
-            if results_keys != last_results_keys:
-                misc.print_row(results_keys, colwidth=12)
-                last_results_keys = results_keys
-            misc.print_row([results[key] for key in results_keys],
-                colwidth=12)
+            if args.save_model_every_checkpoint:
+                save_checkpoint(f'model_step{step}.pkl')
 
-            results.update({
-                'hparams': hparams,
-                'args': vars(args)
-            })
+        if (resume_checkpoint_freq and step % resume_checkpoint_freq == 0
+                and step != n_steps - 1):
+            # Only the evaluation of this very step may still be pending,
+            # which can be redone from the checkpoint.
+            join_evals(before_step=step)
+            save_resume_checkpoint(step)
 
-            epochs_path = os.path.join(args.output_dir, 'results.jsonl')
-            with open(epochs_path, 'a') as f:
-                f.write(json.dumps(results, sort_keys=True) + "\n")
+        if profiler is not None:
+            instrumentation.stop_profiler(profiler,
+                os.path.join(profile_dir, 'step{}'.format(step)))
 
-            algorithm_dict = algorithm.state_dict()
-            start_step = step + 1
-            checkpoint_vals = collections.defaultdict(lambda: [])
+    join_evals(before_step=n_steps)
 
-            if args.save_model_every_checkpoint:
-                save_checkpoint(f'model_step{step}.pkl')
+    if hparams.get('compile', False):
+        # The reasons for the graph breaks, and how often each occurred
+        with open(os.path.join(args.output_dir, 'graph_breaks.json'), 'w') as f:
+            json.dump(dict(torch._dynamo.utils.counters['graph_break']), f,
+                indent=2, sort_keys=True)
 
     save_checkpoint('model.pkl')
 
     with open(os.path.join(args.output_dir, 'done'), 'w') as f:
         f.write('done')
+
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
+
+    heartbeat.stop()
@@ -0,0 +1,38 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+import os
+import unittest
+import uuid
+
+import numpy as np
+
+from domainbed.lib import dataset_cache
+
+class TestDatasetCache(unittest.TestCase):
+
+    def test_save_load_arrays(self):
+        """Test that arrays saved to the cache are read back memory-mapped and
+        unchanged, and that a second writer does not clobber the entry."""
+        path = os.path.join('/tmp', str(uuid.uuid4()),
+            dataset_cache.cache_key('foo', 1))
+        os.makedirs(os.path.dirname(path))
+        self.assertIsNone(dataset_cache.load_arrays(path))
+
+        x = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        y = np.array([0, 1, 0])
+        dataset_cache.save_arrays(path, x=x, y=y)
+        dataset_cache.save_arrays(path, x=x + 1, y=y + 1)
+
+        arrays = dataset_cache.load_arrays(path)
+        self.assertEqual(sorted(arrays.keys()), ['x', 'y'])
+        self.assertIsInstance(arrays['x'], np.memmap)
+        np.testing.assert_array_equal(arrays['x'], x)
+        np.testing.assert_array_equal(arrays['y'], y)
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+            [os.path.basename(path)])
+
+    def test_cache_key(self):
+        self.assertEqual(dataset_cache.cache_key('a', [1, 2]),
+            dataset_cache.cache_key('a', [1, 2]))
+        self.assertNotEqual(dataset_cache.cache_key('a', [1, 2]),
+            dataset_cache.cache_key('a', [2, 1]))
@@ -0,0 +1,113 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+import time
+import unittest
+
+import torch
+
+from domainbed.lib import misc
+from domainbed.lib import fast_data_loader
+from domainbed.lib.fast_data_loader import MultiEnvInfiniteDataLoader
+
+class TestFastDataLoader(unittest.TestCase):
+
+    def test_multi_env_infinite_data_loader(self):
+        """Test that MultiEnvInfiniteDataLoader yields one minibatch per
+        environment, drawn from that environment."""
+        datasets = [torch.utils.data.TensorDataset(
+                torch.full((10, 3), float(i)), torch.full((10,), i))
+            for i in range(3)]
+        loader = MultiEnvInfiniteDataLoader(datasets, [None, None, None],
+            batch_size=4, num_workers=0)
+        for _, minibatches in zip(range(5), loader):
+            self.assertEqual(len(minibatches), 3)
+            for i, (x, y) in enumerate(minibatches):
+                self.assertEqual(list(x.shape), [4, 3])
+                self.assertTrue((x == i).all())
+                self.assertTrue((y == i).all())
+
+    def test_tensor_batch_fetcher(self):
+        """Test that batches fetched from a nested split of a TensorDataset
+        match the collated individual samples."""
+        dataset = torch.utils.data.TensorDataset(
+            torch.randint(0, 256, (20, 2, 4, 4), dtype=torch.uint8),
+            torch.randint(0, 5, (20,)))
+        _, split = misc.split_dataset(dataset, 5, seed=0)
+        split, _ = misc.split_dataset(split, 10, seed=1)
+        fetch = fast_data_loader._tensor_batch_fetcher(split)
+        indices = [3, 0, 7, 7]
+        expected = torch.utils.data.dataloader.default_collate(
+            [split[i] for i in indices])
+        for tensor, expected_tensor in zip(fetch(indices), expected):
+            self.assertTrue(torch.equal(tensor, expected_tensor))
+
+        self.assertIsNone(fast_data_loader._tensor_batch_fetcher(
+            [(torch.zeros(3), 0)]))
+
+    def test_concat_data_loader(self):
+        """Test that ConcatDataLoader reads every sample of every dataset once,
+        in order, both from in-memory tensors and through a DataLoader."""
+        tensor_datasets = [torch.utils.data.TensorDataset(
+                torch.full((n, 3), float(i)), torch.full((n,), i))
+            for i, n in enumerate([5, 7, 2])]
+        _, split = misc.split_dataset(tensor_datasets[1], 3, seed=0)
+        tensor_datasets[1] = split
+        list_datasets = [list(dataset) for dataset in tensor_datasets]
+
+        for datasets in [tensor_datasets, list_datasets]:
+            loader = fast_data_loader.ConcatDataLoader(datasets,
+                batch_size=4, num_workers=0)
+            for _ in range(2):
+                batches = list(loader)
+                self.assertEqual(len(batches), len(loader))
+                x, y, index = [torch.cat(tensors)
+                    for tensors in zip(*batches)]
+                expected = torch.cat([torch.full((len(dataset),), i)
+                    for i, dataset in enumerate(datasets)])
+                self.assertEqual(index.tolist(), list(range(11)))
+                self.assertTrue(torch.equal(y, expected))
+                self.assertTrue((x == expected.view(-1, 1)).all())
+
+    def test_device_prefetcher(self):
+        """Test that DevicePrefetcher yields the batches of the wrapped loader,
+        in order and unchanged, including nested lists and tuples."""
+        batches = [[(torch.randn(4, 3), torch.randint(0, 5, (4,)))
+                for _ in range(2)]
+            for _ in range(5)]
+        prefetcher = fast_data_loader.DevicePrefetcher(batches, 'cpu')
+        self.assertEqual(len(prefetcher), 5)
+        for _ in range(2):
+            prefetched = list(prefetcher)
+            self.assertEqual(len(prefetched), len(batches))
+            for batch, expected_batch in zip(prefetched, batches):
+                self.assertIsInstance(batch, list)
+                for (x, y), (expected_x, expected_y) in zip(batch,
+                        expected_batch):
+                    self.assertTrue(torch.equal(x, expected_x))
+                    self.assertTrue(torch.equal(y, expected_y))
+
+    def test_device_prefetcher_times(self):
+        """Test that wait_time accumulates the time spent in the wrapped
+        loader, one batch ahead, until reset as train.py does every step."""
+        class SlowLoader:
+            def __iter__(self):
+                for i in range(4):
+                    time.sleep(0.02)
+                    yield torch.full((2,), i)
+
+            def __len__(self):
+                return 4
+
+        prefetcher = fast_data_loader.DevicePrefetcher(SlowLoader(), 'cpu')
+        iterator = iter(prefetcher)
+        # The first batch and the prefetched second one
+        self.assertEqual(next(iterator).tolist(), [0, 0])
+        self.assertGreaterEqual(prefetcher.wait_time, 0.04)
+        self.assertGreaterEqual(prefetcher.copy_time, 0)
+        for i in range(1, 4):
+            prefetcher.wait_time, prefetcher.copy_time = 0., 0.
+            self.assertEqual(next(iterator).tolist(), [i, i])
+            if i < 3:
+                self.assertGreaterEqual(prefetcher.wait_time, 0.02)
+            self.assertGreaterEqual(prefetcher.copy_time, 0)
+        self.assertEqual(list(iterator), [])
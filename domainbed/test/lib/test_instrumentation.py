@@ -0,0 +1,36 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+import unittest
+
+import torch
+
+from domainbed.lib import instrumentation
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_phase_timer(self):
+        """Test that the forward, backward and optimizer phases of an update
+        are reported, and that forwards outside of updates are not timed."""
+        module = torch.nn.Module()
+        module.network = torch.nn.Sequential(torch.nn.Linear(3, 3))
+        optimizer = torch.optim.SGD(module.parameters(), lr=0.1)
+        timer = instrumentation.PhaseTimer('cpu')
+        timer.watch_forward(module)
+        try:
+            for _ in range(2):
+                with timer.phase('update'):
+                    loss = module.network(torch.randn(4, 3)).sum()
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+            module.network(torch.randn(4, 3))
+            times = timer.summary()
+        finally:
+            timer.remove()
+
+        self.assertEqual(sorted(times.keys()),
+            ['backward', 'forward', 'optimizer'])
+        for phase_time in times.values():
+            self.assertGreaterEqual(phase_time, 0)
+        self.assertGreater(times['forward'], 0)
+        self.assertEqual(timer.summary()['forward'], 0)
@@ -1,6 +1,10 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
+import math
 import unittest
+
+import torch
+
 from domainbed.lib import misc
 
 class TestMisc(unittest.TestCase):
@@ -12,3 +16,97 @@ class TestMisc(unittest.TestCase):
         self.assertEqual(result[0], result[2])
         self.assertEqual(result[1], result[3])
         self.assertEqual(3 * result[0], result[1])
+
+    def test_split_dataset_labels(self):
+        """Test that the labels of a split are read from the underlying
+        TensorDataset, and yield the same weights as iterating over it."""
+        x = torch.randn(10, 3)
+        y = torch.tensor([0, 1, 1, 2, 0, 0, 1, 2, 2, 2])
+        dataset = torch.utils.data.TensorDataset(x, y)
+        split_a, split_b = misc.split_dataset(dataset, 4, seed=0)
+        _, split_c = misc.split_dataset(split_b, 2, seed=1)
+
+        for split in [split_a, split_b, split_c]:
+            self.assertEqual(misc.get_labels(split).tolist(),
+                [int(label) for _, label in split])
+            self.assertTrue(torch.equal(
+                misc.make_weights_for_balanced_classes(split),
+                misc.make_weights_for_balanced_classes(list(split))))
+
+    def test_split_metrics(self):
+        """Test that split_metrics computes the weighted metrics of each
+        split of the concatenation, including a last, empty one."""
+        class Network(torch.nn.Module):
+            def predict(self, x):
+                return x
+
+        x = 10 * torch.eye(3)[[0, 1, 2, 0, 1, 2]]
+        y = torch.tensor([0, 1, 0, 0, 2, 2])
+        index = torch.arange(6)
+        loader = [(x[:4], y[:4], index[:4]), (x[4:], y[4:], index[4:])]
+        split_ids = torch.tensor([0, 0, 0, 1, 1, 1])
+        weights = torch.tensor([1., 1., 2., 1., 1., 1.])
+        metrics = misc.split_metrics(Network(), loader, split_ids, 3,
+            weights, 3, 'cpu')
+
+        expected_loss = torch.nn.functional.cross_entropy(x, y,
+            reduction='none')
+        self.assertAlmostEqual(metrics[0]['acc'], 0.5)
+        self.assertAlmostEqual(metrics[1]['acc'], 2 / 3, places=6)
+        self.assertAlmostEqual(metrics[0]['loss'],
+            ((expected_loss[:3] * weights[:3]).sum() / 4).item(), places=5)
+        self.assertEqual(metrics[0]['class_acc'][:2], [1 / 3, 1.])
+        self.assertTrue(math.isnan(metrics[0]['class_acc'][2]))
+        self.assertEqual(metrics[1]['class_acc'][0], 1.)
+        self.assertAlmostEqual(metrics[1]['class_acc'][2], 0.5)
+        # All predictions are made with the same confidence
+        confidence = torch.softmax(x[0], 0).max().item()
+        self.assertAlmostEqual(metrics[0]['ece'], abs(confidence - 0.5),
+            places=5)
+        self.assertEqual(len(metrics), 3)
+        self.assertTrue(math.isnan(metrics[2]['acc']))
+
+    def test_to_floats(self):
+        values = [1, torch.tensor(2.5), 0.5, torch.tensor([3])]
+        self.assertEqual(misc.to_floats(values), [1., 2.5, 0.5, 3.])
+        self.assertEqual(misc.to_floats([2]), [2.])
+
+    def test_env_gradients(self):
+        """Test that env_gradients stacks the gradients of the loss on each
+        minibatch, with and without create_graph."""
+        network = torch.nn.Sequential(torch.nn.Linear(3, 4), torch.nn.ReLU(),
+            torch.nn.Linear(4, 2))
+        minibatches = [(torch.randn(n, 3), torch.randint(2, (n,)))
+            for n in [5, 3, 4]]
+        for create_graph in [False, True]:
+            env_losses, grads = misc.env_gradients(network, minibatches,
+                create_graph=create_graph)
+            self.assertEqual(len(grads), 4)
+            for i, (x, y) in enumerate(minibatches):
+                loss = torch.nn.functional.cross_entropy(network(x), y)
+                self.assertAlmostEqual(env_losses[i].item(), loss.item(),
+                    places=5)
+                expected = torch.autograd.grad(loss, network.parameters())
+                for grad, expected_grad in zip(grads, expected):
+                    self.assertTrue(torch.allclose(grad[i], expected_grad,
+                        atol=1e-6))
+            self.assertEqual(grads[0].requires_grad, create_graph)
+
+    def test_split_metrics_labels(self):
+        """Test that split_metrics labels each batch for torch.profiler with
+        the names of the splits it covers."""
+        class Network(torch.nn.Module):
+            def predict(self, x):
+                return x
+
+        x = torch.eye(3)[[0, 1, 2, 0, 1]]
+        y = torch.tensor([0, 1, 2, 0, 1])
+        index = torch.arange(5)
+        loader = [(x[:2], y[:2], index[:2]), (x[2:4], y[2:4], index[2:4]),
+            (x[4:], y[4:], index[4:])]
+        split_ids = torch.tensor([0, 0, 0, 1, 1])
+        with torch.profiler.profile() as profiler:
+            misc.split_metrics(Network(), loader, split_ids, 2, torch.ones(5),
+                3, 'cpu', split_names=['a', 'b'])
+        labels = set(event.key for event in profiler.key_averages())
+        self.assertTrue({'evaluate_a', 'evaluate_a+b', 'evaluate_b'} <= labels)
@@ -0,0 +1,42 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+
+import unittest
+
+from domainbed.lib import reporting
+from domainbed.lib.query import Q
+
+def make_record(dataset, algorithm, times=None, mem_gb=1.):
+    record = {'args': {'dataset': dataset, 'algorithm': algorithm},
+        'mem_gb': mem_gb}
+    if times is not None:
+        phases = ['data', 'copy', 'forward', 'backward', 'optimizer', 'step',
+            'eval']
+        record.update({phase + '_time': t for phase, t in zip(phases, times)})
+    return record
+
+class TestReporting(unittest.TestCase):
+
+    def test_get_phase_times(self):
+        """Test that get_phase_times averages the phase times of the records
+        of each (dataset, algorithm), skipping records without them."""
+        records = Q([
+            make_record('A', 'ERM', [1., 1., 2., 4., 2., 10., 5.], mem_gb=2.),
+            make_record('A', 'ERM', [3., 1., 2., 2., 2., 10., 7.], mem_gb=3.),
+            make_record('A', 'ERM'),
+            make_record('A', 'IRM', [0., 0., 1., 1., 2., 4., 1.]),
+            make_record('B', 'ERM'),
+        ])
+        phase_times = reporting.get_phase_times(records)
+
+        self.assertEqual(len(phase_times), 2)
+        erm, irm = sorted(phase_times, key=lambda r: r['algorithm'])
+        self.assertEqual((erm['dataset'], erm['algorithm']), ('A', 'ERM'))
+        self.assertEqual(erm['data_time'], 2.)
+        self.assertEqual(erm['backward_time'], 3.)
+        self.assertEqual(erm['eval_time'], 6.)
+        self.assertEqual(erm['mem_gb'], 3.)
+        self.assertAlmostEqual(erm['data_fraction'], 3. / 10.)
+        self.assertEqual(irm['data_fraction'], 0.)
+
+        self.assertEqual(len(reporting.get_phase_times(
+            Q([make_record('A', 'ERM')]))), 0)
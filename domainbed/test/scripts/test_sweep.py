@@ -16,6 +16,7 @@ from domainbed import datasets
 from domainbed import hparams_registry
 from domainbed import algorithms
 from domainbed import networks
+from domainbed.lib import misc
 from domainbed.test import helpers
 from domainbed.scripts import sweep
 
@@ -66,6 +67,52 @@ class TestSweep(unittest.TestCase):
         job = sweep.Job(train_args, sweep_output_dir)
         self.assertEqual(job.state, sweep.Job.NOT_LAUNCHED)
 
+    def test_job_resumable(self):
+        """Test that a launched job which left a checkpoint behind is
+        RESUMABLE until it is done."""
+        train_args = {'foo': 'bar'}
+        sweep_output_dir = f'/tmp/{str(uuid.uuid4())}'
+        job = sweep.Job(train_args, sweep_output_dir)
+        sweep.Job.launch([job], (lambda commands: None))
+        with open(os.path.join(job.output_dir, 'checkpoint.pkl'), 'w') as f:
+            f.write('')
+
+        job = sweep.Job(train_args, sweep_output_dir)
+        self.assertEqual(job.state, sweep.Job.RESUMABLE)
+        self.assertEqual(sweep.jobs_to_launch([job]), [job])
+
+        with open(os.path.join(job.output_dir, 'done'), 'w') as f:
+            f.write('done')
+        job = sweep.Job(train_args, sweep_output_dir)
+        self.assertEqual(job.state, sweep.Job.DONE)
+
+    def test_job_running_not_resumed(self):
+        """Test that a job which is still running, i.e. keeps its heartbeat
+        fresh, is not relaunched although it has a checkpoint, and that it
+        becomes RESUMABLE once its heartbeat goes stale."""
+        train_args = {'foo': 'bar'}
+        sweep_output_dir = f'/tmp/{str(uuid.uuid4())}'
+        job = sweep.Job(train_args, sweep_output_dir)
+        sweep.Job.launch([job], (lambda commands: None))
+        with open(os.path.join(job.output_dir, 'checkpoint.pkl'), 'w') as f:
+            f.write('')
+        heartbeat_path = os.path.join(job.output_dir, 'heartbeat')
+        heartbeat = misc.Heartbeat(heartbeat_path)
+        try:
+            job = sweep.Job(train_args, sweep_output_dir)
+            self.assertEqual(job.state, sweep.Job.INCOMPLETE)
+            self.assertEqual(sweep.jobs_to_launch([job]), [])
+        finally:
+            heartbeat.stop()
+
+        with open(heartbeat_path, 'w') as f:
+            f.write('')
+        stale_time = time.time() - 2 * misc.Heartbeat.TIMEOUT
+        os.utime(heartbeat_path, (stale_time, stale_time))
+        job = sweep.Job(train_args, sweep_output_dir)
+        self.assertEqual(job.state, sweep.Job.RESUMABLE)
+        self.assertEqual(sweep.jobs_to_launch([job]), [job])
+
 
     def test_make_args_list(self):
         """Test that, for a typical input, make_job_list returns a list
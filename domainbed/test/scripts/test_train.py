@@ -47,3 +47,27 @@ class TestTrain(unittest.TestCase):
         with open(os.path.join(output_dir, 'out.txt')) as f:
             text = f.read()
             self.assertTrue('500' in text)
+
+    def test_async_eval(self):
+        """Test that evaluating checkpoints asynchronously writes the same
+        results as evaluating them synchronously, training included."""
+        rows = []
+        for async_eval in ['', '--async_eval']:
+            output_dir = os.path.join('/tmp', str(uuid.uuid4()))
+            subprocess.run(f'python -m domainbed.scripts.train '
+                f'--dataset Debug28 --algorithm Mixup --data_dir=/tmp '
+                f'--output_dir={output_dir} --steps=7 --checkpoint_freq=2 '
+                f'--hparams \'{{"batch_size": 8}}\' '
+                f'--skip_model_save {async_eval}', shell=True, check=True)
+            with open(os.path.join(output_dir, 'results.jsonl')) as f:
+                rows.append([json.loads(line) for line in f])
+
+        # Timings, memory statistics and args differ between the runs. Rows
+        # are compared serialized, as the accuracies of absent classes are NaN
+        def results(row):
+            return json.dumps({key: value for key, value in row.items()
+                if not key.endswith('_time') and not key.endswith('_gb')
+                and key != 'args'}, sort_keys=True)
+        self.assertEqual([row['step'] for row in rows[0]], [0, 2, 4, 6])
+        self.assertEqual([results(row) for row in rows[0]],
+            [results(row) for row in rows[1]])
@@ -11,8 +11,14 @@ import sys
 import time
 import unittest
 import uuid
+from unittest import mock
 
+import numpy as np
 import torch
+from PIL import Image, ImageDraw
+from torchvision import transforms
+from torchvision.datasets import ImageFolder
+from torchvision.transforms.functional import rotate
 
 from domainbed import datasets
 from domainbed import hparams_registry
@@ -47,3 +53,120 @@ class TestDatasets(unittest.TestCase):
             hparams).cuda()
         minibatches = helpers.make_minibatches(dataset, batch_size)
         algorithm.update(minibatches)
+
+    def test_cached_image_folder(self):
+        """Test that a CachedImageFolder yields the samples and labels of the
+        ImageFolder it wraps, and that a second one reads them back from the
+        cache without decoding any image."""
+        root = os.path.join('/tmp', str(uuid.uuid4()))
+        for label, class_name in enumerate(['a', 'b']):
+            os.makedirs(os.path.join(root, 'env', class_name))
+            for i in range(3):
+                image = np.random.RandomState(3 * label + i).randint(0, 256,
+                    (20 + i, 30, 3), dtype=np.uint8)
+                Image.fromarray(image).save(os.path.join(root, 'env',
+                    class_name, '{}.png'.format(i)))
+
+        resize = transforms.Resize((8, 8))
+        image_folder = ImageFolder(os.path.join(root, 'env'),
+            transform=transforms.ToTensor())
+        expected = ImageFolder(os.path.join(root, 'env'),
+            transform=transforms.Compose([resize, transforms.ToTensor()]))
+        path = os.path.join(root, 'cache', 'env')
+        cached = datasets.CachedImageFolder(image_folder, resize, path)
+
+        def fail(image_path):
+            raise AssertionError('image decoded on a cache hit')
+        image_folder.loader = fail
+        cached_again = datasets.CachedImageFolder(image_folder, resize, path)
+
+        self.assertEqual(len(cached), len(expected))
+        self.assertEqual(cached.classes, expected.classes)
+        for dataset in [cached, cached_again]:
+            for (x, y), (expected_x, expected_y) in zip(dataset, expected):
+                self.assertEqual(y, expected_y)
+                self.assertTrue(torch.equal(x, expected_x))
+
+    def test_image_folder_cache_skips_augmented_envs(self):
+        """Test that with data augmentation, only the environments that are
+        not augmented are cached, so that caching never changes the
+        inputs."""
+        root = os.path.join('/tmp', str(uuid.uuid4()), 'data')
+        for environment in ['A', 'B']:
+            os.makedirs(os.path.join(root, environment, 'a'))
+            Image.fromarray(np.zeros((20, 30, 3), dtype=np.uint8)).save(
+                os.path.join(root, environment, 'a', '0.png'))
+        dataset = datasets.MultipleEnvironmentImageFolder(root, [0], True,
+            {'dataset_cache': True})
+        self.assertIsInstance(dataset[0], datasets.CachedImageFolder)
+        self.assertNotIsInstance(dataset[1], datasets.CachedImageFolder)
+
+    def test_rotated_mnist_rotation(self):
+        """Test that the batched rotation of RotatedMNIST matches the per-image
+        torchvision rotate() it replaces, on a few digit-like strokes."""
+        strokes = [
+            [(6, 6, 21, 6), (21, 6, 10, 22)],                   # 7
+            [(14, 5, 14, 23), (10, 9, 14, 5)],                  # 1
+            [(8, 5, 8, 15), (8, 15, 20, 15), (17, 5, 17, 23)],  # 4
+        ]
+        images = []
+        for lines in strokes:
+            image = Image.new('L', (28, 28))
+            draw = ImageDraw.Draw(image)
+            for line in lines:
+                draw.line(line, fill=255, width=3)
+            images.append(torch.from_numpy(np.array(image)))
+        images = torch.stack(images)
+        labels = torch.tensor([7, 1, 4])
+
+        rotated_mnist = object.__new__(datasets.RotatedMNIST)
+        for angle in [0, 15, 30, 45, 60, 75]:
+            x, y = rotated_mnist.rotate_dataset(images, labels, angle).tensors
+            self.assertEqual(x.dtype, torch.uint8)
+            self.assertTrue(torch.equal(y, labels))
+            for image, rotated in zip(images, x):
+                expected = transforms.ToTensor()(rotate(
+                    transforms.ToPILImage()(image), angle, fill=(0,),
+                    interpolation=transforms.InterpolationMode.BILINEAR))
+                error = (rotated.float() / 255 - expected).abs()
+                self.assertLess(error.mean().item(), 0.03, angle)
+
+    @parameterized.expand([('ColoredMNIST',), ('RotatedMNIST',)])
+    def test_mnist_cache(self, dataset_name):
+        """Test that a cached MNIST-family dataset built again from the same
+        RNG state is read back from the cache, identical and leaving the RNG
+        in the same state, and that another RNG state misses the cache."""
+        class FakeMNIST:
+            def __init__(self, root, train, download):
+                generator = torch.Generator().manual_seed(int(train))
+                self.data = torch.randint(0, 256, (30, 28, 28),
+                    dtype=torch.uint8, generator=generator)
+                self.targets = torch.randint(0, 10, (30,),
+                    generator=generator)
+
+        dataset_class = datasets.get_dataset_class(dataset_name)
+        make_environments = dataset_class.make_environments
+        n_builds = []
+        def counting_make_environments(self, *args):
+            n_builds.append(1)
+            return make_environments(self, *args)
+
+        root = os.path.join('/tmp', str(uuid.uuid4()))
+        hparams = {'dataset_cache': True}
+        built = []
+        with mock.patch.object(datasets, 'MNIST', FakeMNIST), \
+                mock.patch.object(dataset_class, 'make_environments',
+                    counting_make_environments):
+            for seed in [0, 0, 1]:
+                torch.manual_seed(seed)
+                built.append((dataset_class(root, [], hparams),
+                    torch.get_rng_state()))
+
+        self.assertEqual(len(n_builds), 2)
+        (dataset, rng_state), (cached, cached_rng_state) = built[:2]
+        self.assertTrue(torch.equal(rng_state, cached_rng_state))
+        for env, cached_env in zip(dataset, cached):
+            for tensor, cached_tensor in zip(env.tensors, cached_env.tensors):
+                self.assertTrue(torch.equal(tensor, cached_tensor))
+        self.assertFalse(torch.equal(dataset[0].tensors[0],
+            built[2][0][0].tensors[0]))
@@ -3,21 +3,26 @@
 """Unit tests."""
 
 import argparse
+import io
 import itertools
 import json
 import os
+import random
 import subprocess
 import sys
 import time
 import unittest
 import uuid
 
+import numpy as np
 import torch
 
 from domainbed import datasets
 from domainbed import hparams_registry
 from domainbed import algorithms
 from domainbed import networks
+from domainbed.lib import misc
+from domainbed.lib.fast_data_loader import MultiEnvInfiniteDataLoader
 from domainbed.test import helpers
 
 from parameterized import parameterized
@@ -41,3 +46,170 @@ class TestAlgorithms(unittest.TestCase):
         algorithm.eval()
         self.assertEqual(list(algorithm.predict(minibatches[0][0]).shape),
             [batch_size, dataset.num_classes])
+
+    def test_precision_fallback(self):
+        """Test that algorithms which take gradients themselves train in bf16
+        when fp16 is asked for, as they do not support loss scaling."""
+        hparams = hparams_registry.default_hparams('IRM', 'Debug28')
+        hparams['precision'] = 'fp16'
+        dataset = datasets.get_dataset_class('Debug28')('', [], hparams)
+        with self.assertWarns(UserWarning):
+            algorithm = algorithms.IRM(dataset.input_shape,
+                dataset.num_classes, len(dataset), hparams)
+        self.assertEqual(algorithm.precision, 'bf16')
+        algorithm = algorithms.ERM(dataset.input_shape, dataset.num_classes,
+            len(dataset), hparams)
+        self.assertEqual(algorithm.precision, 'fp16')
+
+    def test_mmd_penalty(self):
+        """Test that the MMD and CORAL penalties computed over all the
+        environments at once are the sums of their pair-wise values, and
+        that the random Fourier features approximate the MMD."""
+        hparams = hparams_registry.default_hparams('MMD', 'Debug28')
+        dataset = datasets.get_dataset_class('Debug28')('', [], hparams)
+        torch.manual_seed(0)
+        sizes = [6, 4, 5]
+        features = torch.randn(sum(sizes), 3)
+        envs = features.split(sizes)
+        pairs = list(itertools.combinations(envs, 2))
+
+        mmd = algorithms.MMD(dataset.input_shape, dataset.num_classes,
+            len(dataset), hparams)
+        expected = sum(mmd.gaussian_kernel(x, x).mean()
+            + mmd.gaussian_kernel(y, y).mean()
+            - 2 * mmd.gaussian_kernel(x, y).mean() for x, y in pairs)
+        self.assertAlmostEqual(mmd.penalty(features, sizes).item(),
+            expected.item(), places=4)
+        mmd.hparams['mmd_rff_dim'] = 20000
+        self.assertAlmostEqual(mmd.penalty(features, sizes).item(),
+            expected.item(), delta=0.05 * expected.item())
+
+        coral = algorithms.CORAL(dataset.input_shape, dataset.num_classes,
+            len(dataset), hparams)
+        expected = sum((x.mean(0) - y.mean(0)).pow(2).mean()
+            + (x.T.cov() - y.T.cov()).pow(2).mean() for x, y in pairs)
+        self.assertAlmostEqual(coral.penalty(features, sizes).item(),
+            expected.item(), places=5)
+
+    @parameterized.expand([('ERM',), ('Fish',), ('Fishr',), ('TRM',)])
+    def test_resume(self, algorithm_name):
+        """Test that training for a few steps, checkpointing the full training
+        state and resuming from it, the way train.py does, draws the same
+        minibatches and ends with the same parameters as an uninterrupted
+        run."""
+        n_steps, n_resumed_steps = 3, 3
+
+        def start(start_step):
+            # Like train.py: seed, then build the dataset, loader and algorithm
+            random.seed(0)
+            np.random.seed(0)
+            torch.manual_seed(0)
+            hparams = hparams_registry.default_hparams(algorithm_name,
+                'Debug28')
+            dataset = datasets.get_dataset_class('Debug28')('', [], hparams)
+            loader = MultiEnvInfiniteDataLoader(list(dataset),
+                [None] * len(dataset), batch_size=4, num_workers=0,
+                skip_batches=start_step)
+            algorithm = algorithms.get_algorithm_class(algorithm_name)(
+                dataset.input_shape, dataset.num_classes, len(dataset),
+                hparams)
+            return iter(loader), algorithm
+
+        def train(loader, algorithm, n):
+            batches = []
+            for _ in range(n):
+                batches.append(next(loader))
+                algorithm.update([(misc.to_float_images(x), y)
+                    for x, y in batches[-1]])
+            return batches
+
+        loader, algorithm = start(0)
+        expected_batches = train(loader, algorithm, n_steps + n_resumed_steps)
+        expected_state = algorithm.state_dict()
+
+        loader, algorithm = start(0)
+        train(loader, algorithm, n_steps)
+        checkpoint = io.BytesIO()
+        torch.save({
+            'model_dict': algorithm.state_dict(),
+            'training_state': algorithm.training_state_dict(),
+            'rng_state': misc.get_rng_state(),
+        }, checkpoint)
+        checkpoint.seek(0)
+        checkpoint = torch.load(checkpoint, weights_only=False)
+
+        loader, algorithm = start(n_steps)
+        algorithm.load_state_dict(checkpoint['model_dict'])
+        algorithm.load_training_state_dict(checkpoint['training_state'])
+        misc.set_rng_state(checkpoint['rng_state'])
+        batches = train(loader, algorithm, n_resumed_steps)
+
+        for minibatches, expected_minibatches in zip(batches,
+                expected_batches[n_steps:]):
+            for tensors, expected_tensors in zip(minibatches,
+                    expected_minibatches):
+                for tensor, expected_tensor in zip(tensors, expected_tensors):
+                    self.assertTrue(torch.equal(tensor, expected_tensor))
+        for name, value in algorithm.state_dict().items():
+            self.assertTrue(torch.equal(value, expected_state[name]), name)
+
+    def test_hparams_without_new_keys(self):
+        """Test that algorithms still build and train from hparams saved
+        before the precision and performance hparams were introduced."""
+        hparams = hparams_registry.default_hparams('ERM', 'Debug28')
+        for key in ['precision', 'compile', 'channels_last', 'resnet_fold_bn',
+                    'resnet_checkpoint_segments', 'dataset_cache']:
+            del hparams[key]
+        dataset = datasets.get_dataset_class('Debug28')('', [], hparams)
+        algorithm = algorithms.ERM(dataset.input_shape, dataset.num_classes,
+            len(dataset), hparams)
+        self.assertEqual(algorithm.precision, 'fp32')
+        self.assertIsNone(algorithm.scaler)
+        minibatches = [(x.cpu(), y.cpu())
+            for x, y in helpers.make_minibatches(dataset, 8)]
+        algorithm.update(minibatches)
+        algorithm.load_training_state_dict(algorithm.training_state_dict())
+
+    mldg_reference = [-0.03792651, -0.00201153, -0.00294830, 0.00688681,
+        -0.12392231, -0.01786106, 0.00599562, 0.00289062]
+
+    @parameterized.expand([
+        ('Fish', {}, [6, 8, 10], [0.02333362, -0.00310749, -0.01473822,
+            0.00122302, -0.02966879, 0.00430201, -0.00074744, -0.00128331]),
+        ('MLDG', {'weight_decay': 1e-3}, [8, 8, 8], mldg_reference),
+        ('MLDG', {'weight_decay': 1e-3, 'mldg_vmap': True}, [8, 8, 8],
+            mldg_reference),
+        ('GroupDRO', {}, [6, 8, 10], [0.00991453, 0.00253498, -0.00393464,
+            0.01190171, -0.06913257, -0.00078489, 0.00550471, -0.00299726,
+            0.33284777, 0.33332503, 0.33382726]),
+        ('Mixup', {}, [6, 8, 10], [0.00296552, -0.00569021, 0.01439746,
+            -0.00147262, 0.00975609, 0.00328956, -0.00012415, 0.00006516]),
+    ])
+    def test_update_reference(self, algorithm_name, hparams_update, sizes,
+                              expected):
+        """Test that three updates of the algorithms whose update was
+        rewritten move the weights of a small MLP as the original update did.
+        expected holds the sums of the changes of the parameters of the
+        network (then the final q of GroupDRO) under the original update."""
+        hparams = hparams_registry.default_hparams(algorithm_name, 'Debug28')
+        hparams.update({'mlp_width': 16, 'mlp_depth': 3, 'mlp_dropout': 0.})
+        hparams.update(hparams_update)
+        generator = torch.Generator().manual_seed(0)
+        minibatches = [(torch.randn(n, 10, generator=generator),
+                        torch.randint(3, (n,), generator=generator))
+            for n in sizes]
+        torch.manual_seed(0)
+        algorithm = algorithms.get_algorithm_class(algorithm_name)((10,), 3,
+            len(minibatches), hparams)
+        initial = [p.detach().clone() for p in algorithm.network.parameters()]
+        torch.manual_seed(0)
+        np.random.seed(0)
+        for _ in range(3):
+            algorithm.update(minibatches)
+        changes = [(p - p0).sum().item()
+            for p, p0 in zip(algorithm.network.parameters(), initial)]
+        if algorithm_name == 'GroupDRO':
+            changes += algorithm.q.tolist()
+        for change, expected_change in zip(changes, expected):
+            self.assertAlmostEqual(change, expected_change, places=6)
+        self.assertEqual(len(changes), len(expected))
@@ -1,6 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
 import argparse
+import copy
 import itertools
 import json
 import os
@@ -11,6 +12,7 @@ import unittest
 import uuid
 
 import torch
+import torchvision
 
 from domainbed import datasets
 from domainbed import hparams_registry
@@ -35,3 +37,72 @@ class TestNetworks(unittest.TestCase):
         algorithm = networks.Featurizer(input_shape, hparams).cuda()
         output = algorithm(input_)
         self.assertEqual(list(output.shape), [batch_size, algorithm.n_outputs])
+
+    def test_fold_batch_norm_into_resnet(self):
+        """Test that a ResNet with its frozen BNs folded into the convolutions
+        computes the same outputs and gradients as the original, keeps its
+        state_dict keys, and fuses into the same model for inference."""
+        torch.manual_seed(0)
+        model = torchvision.models.resnet18()
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.uniform_(-1, 1)
+                m.running_var.uniform_(0.5, 2)
+                m.weight.data.uniform_(0.5, 2)
+                m.bias.data.uniform_(-1, 1)
+        model.eval()
+        folded = networks.fold_batch_norm_into_resnet(copy.deepcopy(model))
+        folded.eval()
+        self.assertEqual(list(model.state_dict().keys()),
+            list(folded.state_dict().keys()))
+
+        x = torch.randn(2, 3, 64, 64)
+        model(x).sum().backward()
+        folded(x).sum().backward()
+        self.assertTrue(torch.allclose(model(x), folded(x), atol=1e-4))
+        for p, p_folded in zip(model.parameters(), folded.parameters()):
+            self.assertTrue(torch.allclose(p.grad, p_folded.grad, rtol=1e-3,
+                atol=1e-4))
+
+        fused = networks.remove_batch_norm_from_resnet(folded).eval()
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(model(x), fused(x), atol=1e-4))
+
+    def test_channels_last(self):
+        """Test that a channels_last featurizer computes the same features."""
+        hparams = hparams_registry.default_hparams('ERM', 'Debug28')
+        featurizer = networks.Featurizer((2, 28, 28), hparams)
+        hparams['channels_last'] = True
+        featurizer_cl = networks.Featurizer((2, 28, 28), hparams)
+        featurizer_cl.load_state_dict(featurizer.state_dict())
+        self.assertTrue(featurizer_cl.conv1.weight.is_contiguous(
+            memory_format=torch.channels_last))
+
+        x = torch.randn(4, 2, 28, 28)
+        self.assertTrue(torch.allclose(featurizer(x), featurizer_cl(x),
+            atol=1e-5))
+
+    def test_resnet_checkpoint_segments(self):
+        """Test that activation checkpointing does not change the features
+        of a ResNet, nor their gradients."""
+        x = torch.randn(2, 3, 224, 224)
+        outputs, grads = [], []
+        state_dict = None
+        for segments in [0, 3]:
+            hparams = hparams_registry.default_hparams('ERM', 'Debug224')
+            hparams['resnet18'] = True
+            hparams['resnet_checkpoint_segments'] = segments
+            featurizer = networks.Featurizer((3, 224, 224), hparams)
+            if state_dict is None:
+                state_dict = copy.deepcopy(featurizer.state_dict())
+            featurizer.load_state_dict(state_dict)
+            output = featurizer(x)
+            output.sum().backward()
+            outputs.append(output.detach())
+            grads.append(featurizer.network.conv1.weight.grad.clone())
+        self.assertTrue(torch.allclose(outputs[0], outputs[1], atol=1e-5))
+        self.assertTrue(torch.allclose(grads[0], grads[1], atol=1e-5))
+
+        hparams['resnet_checkpoint_segments'] = 12
+        with self.assertRaises(ValueError):
+            networks.Featurizer((3, 224, 224), hparams)